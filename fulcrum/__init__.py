@@ -1,3 +1,5 @@
 #import django
 #django.setup()
-from fulcrum.sites import site
\ No newline at end of file
+from fulcrum.sites import site
+
+default_app_config = 'fulcrum.apps.FulcrumConfig'
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+
+class FulcrumConfig(AppConfig):
+    name = 'fulcrum'
+    verbose_name = 'Fulcrum'
+    
+    def ready(self):
+        # The user model is only known once the apps are loaded.
+        from fulcrum.models import user_changed
+        
+        user = get_user_model()
+        post_save.connect(user_changed, sender=user, dispatch_uid='fulcrum.user_changed')
+        post_delete.connect(user_changed, sender=user, dispatch_uid='fulcrum.user_changed')
@@ -3,8 +3,11 @@ from django.http import HttpResponse, HttpResponseRedirect
 #from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.auth.decorators import login_required
 from django.template import loader
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import authenticate, login, get_user_model
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.crypto import salted_hmac
 from django.core.urlresolvers import get_callable
 from django.core.exceptions import ImproperlyConfigured
 from django.shortcuts import render_to_response
@@ -18,16 +21,103 @@ class NoAuthentication(object):
     True, so no authentication is needed, nor
     initiated (`challenge` is missing.)
     """
+    scheme = 'none'
+    
     def is_authenticated(self, request):
         return True
 
+class CredentialCache(object):
+    """
+    Short-lived cache of successfully verified `Authorization`
+    headers, so repeated calls from the same client skip the
+    (deliberately slow) password hasher.
+    
+    Entries are keyed on a keyed hash of the header, never the
+    header itself, and hold the user's pk along with a stamp of
+    their password hash and active flag. Changing either one
+    invalidates every cached entry for that user.
+    
+    `scope` names the check that verified the header, so one
+    authenticator's entries are never taken by another that
+    verifies differently. See `authenticator_scope`.
+    """
+    def __init__(self, timeout, scope=''):
+        self.timeout = timeout
+        self.scope = scope
+        
+    def key(self, auth_string):
+        digest = salted_hmac('fulcrum.authentication.CredentialCache',
+                             '%s\n%s' % (self.scope, auth_string)).hexdigest()
+        return 'fulcrum:auth:%s' % digest
+        
+    @staticmethod
+    def stamp(user):
+        value = '%s:%s' % (user.password, user.is_active)
+        return salted_hmac('fulcrum.authentication.CredentialCache.stamp', value).hexdigest()
+        
+    def get(self, auth_string):
+        """
+        Returns the user previously verified for `auth_string`,
+        or None if there is no valid entry.
+        """
+        key = self.key(auth_string)
+        entry = cache.get(key)
+        
+        if entry is None:
+            return None
+        
+        pk, stamp = entry
+        
+        try:
+            user = get_user_model()._default_manager.get(pk=pk)
+        except ObjectDoesNotExist:
+            user = None
+            
+        if user is None or self.stamp(user) != stamp:
+            cache.delete(key)
+            return None
+        
+        return user
+        
+    def set(self, auth_string, user):
+        cache.set(self.key(auth_string), (user.pk, self.stamp(user)), self.timeout)
+
+def authenticator_scope(auth_func, realm):
+    """
+    Names the check `auth_func` makes for `realm`, the same in every
+    process. Functions are told apart by where they're defined, so
+    two lambdas in one module don't share a scope.
+    """
+    code = getattr(auth_func, 'func_code', None)
+    where = code is not None and '%s:%d' % (code.co_filename, code.co_firstlineno) or ''
+    
+    return '%s.%s@%s:%s' % (getattr(auth_func, '__module__', ''),
+                            getattr(auth_func, '__name__', type(auth_func).__name__),
+                            where, realm)
+
+def get_credential_cache(timeout=None, scope=''):
+    """
+    Returns a `CredentialCache` for `scope`, or None if caching is
+    disabled. The timeout defaults to `FULCRUM_AUTH_CACHE_TIMEOUT`
+    (seconds, 0 disables the cache.)
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'FULCRUM_AUTH_CACHE_TIMEOUT', 0)
+    
+    if not timeout:
+        return None
+    
+    return CredentialCache(timeout, scope)
+
 class DjangoAuthentication(object):
     """
     Django authenticator.
     """
+    scheme = 'basic'
     
-    def __init__(self, realm='API'):
+    def __init__(self, realm='API', cache_timeout=None):
         self.realm = realm
+        self.credentials = get_credential_cache(cache_timeout, authenticator_scope(authenticate, realm))
     
     def is_authenticated(self, request):
         
@@ -43,14 +133,27 @@ class DjangoAuthentication(object):
         
         if not authmeth.lower() == 'basic':
             return False
+        
+        if self.credentials is not None:
+            user = self.credentials.get(auth_string)
+            if user is not None:
+                request.user = user
+                return True
             
         auth = auth.strip().decode('base64')
         (username, password) = auth.split(':', 1)
         
+        from django.contrib.auth.models import AnonymousUser
+        
         request.user = authenticate(username=username, password=password) \
             or AnonymousUser()
         
-        return not request.user in (False, None, AnonymousUser())
+        authenticated = not request.user in (False, None, AnonymousUser())
+        
+        if authenticated and self.credentials is not None:
+            self.credentials.set(auth_string, request.user)
+        
+        return authenticated
         
     def challenge(self):
         resp = HttpResponse("Authorization Required")
@@ -71,10 +174,20 @@ class HttpBasicAuthentication(object):
         False, the result of this method will be returned.
         This will usually be a `HttpResponse` object with
         some kind of challenge headers and 401 code on it.
+    
+    Handlers may also set `scheme`, which is published in the
+    site description (`FulcrumSite.api_description`.)
+    
+    Pass `cache_timeout` (or set `FULCRUM_AUTH_CACHE_TIMEOUT`) to
+    remember verified credentials for that many seconds. See
+    `CredentialCache`.
     """
-    def __init__(self, auth_func=authenticate, realm='API'):
+    scheme = 'basic'
+    
+    def __init__(self, auth_func=authenticate, realm='API', cache_timeout=None):
         self.auth_func = auth_func
         self.realm = realm
+        self.credentials = get_credential_cache(cache_timeout, authenticator_scope(auth_func, realm))
 
     def is_authenticated(self, request):
         auth_string = request.META.get('HTTP_AUTHORIZATION', None)
@@ -86,14 +199,27 @@ class HttpBasicAuthentication(object):
         
         if not authmeth.lower() == 'basic':
             return False
+        
+        if self.credentials is not None:
+            user = self.credentials.get(auth_string)
+            if user is not None:
+                request.user = user
+                return True
             
         auth = auth.strip().decode('base64')
         (username, password) = auth.split(':', 1)
         
+        from django.contrib.auth.models import AnonymousUser
+        
         request.user = self.auth_func(username=username, password=password) \
             or AnonymousUser()
         
-        return not request.user in (False, None, AnonymousUser())
+        authenticated = not request.user in (False, None, AnonymousUser())
+        
+        if authenticated and self.credentials is not None:
+            self.credentials.set(auth_string, request.user)
+        
+        return authenticated
         
     def challenge(self):
         resp = HttpResponse("Authorization Required")
@@ -101,10 +227,18 @@ class HttpBasicAuthentication(object):
         resp.status_code = 401
         return resp
 
+# Data store classes resolved from `OAUTH_DATA_STORE`, keyed on path.
+_data_stores = {}
+
 def load_data_store():
     '''Load data store for OAuth Consumers, Tokens, Nonces and Resources
     '''
     path = getattr(settings, 'OAUTH_DATA_STORE', 'fulcrum.store.DataStore')
+    
+    try:
+        return _data_stores[path]
+    except KeyError:
+        pass
 
     # stolen from django.contrib.auth.load_backend
     i = path.rfind('.')
@@ -120,26 +254,30 @@ def load_data_store():
     except AttributeError:
         raise ImproperlyConfigured, 'Module %s does not define a "%s" OAuth data store' % (module, attr)
 
+    _data_stores[path] = cls
     return cls
 
 # Set the datastore here.
 #oauth_datastore = load_data_store()
 
+# Signature methods hold no per-request state, so every
+# server shares the same instances.
+SIGNATURE_METHODS = dict([ (m.get_name(), m) for m in (
+    oauth.OAuthSignatureMethod_PLAINTEXT(),
+    oauth.OAuthSignatureMethod_HMAC_SHA1()) ])
+
 def initialize_server_request(request):
     """
     Shortcut for initialization.
     """
-    oauth_datastore = load_data_store()
-
     oauth_request = oauth.OAuthRequest.from_request(
         request.method, request.build_absolute_uri(), 
         headers=request.META, parameters=dict(request.REQUEST.items()),
         query_string=request.environ.get('QUERY_STRING', ''))
         
     if oauth_request:
-        oauth_server = oauth.OAuthServer(oauth_datastore(oauth_request))
-        oauth_server.add_signature_method(oauth.OAuthSignatureMethod_PLAINTEXT())
-        oauth_server.add_signature_method(oauth.OAuthSignatureMethod_HMAC_SHA1())
+        oauth_datastore = load_data_store()
+        oauth_server = oauth.OAuthServer(oauth_datastore(oauth_request), SIGNATURE_METHODS)
     else:
         oauth_server = None
         
@@ -243,11 +381,17 @@ def oauth_access_token(request):
         return send_oauth_error(err)
 
 INVALID_PARAMS_RESPONSE = send_oauth_error(oauth.OAuthError('Invalid request parameters.'))
+
+OAUTH_PARAMETERS = tuple([ 'oauth_'+s for s in [
+    'consumer_key', 'token', 'signature',
+    'signature_method', 'timestamp', 'nonce' ] ])
                 
 class OAuthAuthentication(object):
     """
     OAuth authentication. Based on work by Leah Culver.
     """
+    scheme = 'oauth'
+    
     def __init__(self, realm='API'):
         self.realm = realm
         self.builder = oauth.build_authenticate_header
@@ -269,7 +413,7 @@ class OAuthAuthentication(object):
 
             if consumer and token:
                 request.user = token.user
-                request.throttle_extra = token.consumer.id
+                request.throttle_extra = token.consumer_id
                 return True
             
         return False
@@ -307,16 +451,11 @@ class OAuthAuthentication(object):
         which is by the way the preferred method according to
         OAuth spec, but otherwise fall back to `GET` and `POST`.
         """
-        must_have = [ 'oauth_'+s for s in [
-            'consumer_key', 'token', 'signature',
-            'signature_method', 'timestamp', 'nonce' ] ]
-        
-        is_in = lambda l: all([ (p in l) for p in must_have ])
+        is_in = lambda l: all(p in l for p in OAUTH_PARAMETERS)
 
         auth_params = request.META.get("HTTP_AUTHORIZATION", "")
-        req_params = request.REQUEST
              
-        return is_in(auth_params) or is_in(req_params)
+        return is_in(auth_params) or is_in(request.REQUEST)
         
     @staticmethod
     def validate_token(request, check_timestamp=True, check_nonce=True):
@@ -0,0 +1,325 @@
+"""
+Small caching helpers used across fulcrum.
+"""
+
+import hashlib, os, tempfile, threading, time
+
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.conf import settings
+from django.db.models import FieldDoesNotExist
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils.cache import patch_cache_control, patch_vary_headers, add_never_cache_headers
+
+from fulcrum import log
+
+class LocalCache(object):
+    """
+    Process-local LRU cache. Entries expire `timeout`
+    seconds after they were set, and the least recently
+    used entry is dropped once `max_size` is reached.
+    """
+    def __init__(self, max_size=1024, timeout=30):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            
+            if expires < time.time():
+                return default
+            
+            # Re-insert to mark as most recently used.
+            self._data[key] = (expires, value)
+            return value
+        
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.timeout, value)
+            
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class TieredCache(object):
+    """
+    A `LocalCache` in front of Django's cache. Reads try the
+    local tier first; writes and deletes go through to both.
+    
+    Deletes only reach the local tier of the current process,
+    so keep `local_timeout` short: it bounds how long other
+    processes may serve a stale entry.
+    """
+    def __init__(self, prefix, timeout=300, local_timeout=30, max_size=1024):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.local = LocalCache(max_size, local_timeout)
+        
+    def make_key(self, key):
+        return 'fulcrum:%s:%s' % (self.prefix, key)
+        
+    def get(self, key):
+        value = self.local.get(key)
+        
+        if value is None:
+            value = cache.get(self.make_key(key))
+            if value is not None:
+                self.local.set(key, value)
+        
+        return value
+        
+    def set(self, key, value):
+        cache.set(self.make_key(key), value, self.timeout)
+        self.local.set(key, value)
+        
+    def delete(self, key):
+        cache.delete(self.make_key(key))
+        self.local.delete(key)
+
+class CachePolicy(object):
+    """
+    HTTP caching policy for a resource, passed to `FulcrumSite.register`
+    as `cache_policy`. Applies to successful GET and HEAD responses;
+    anything else is marked never-cache, as are all responses of
+    resources without a policy.
+    
+    Parameters::
+     - `max_age`: Seconds browsers (and proxies) may reuse a response.
+     - `s_maxage`: Seconds shared caches may reuse it, if different.
+     - `stale_while_revalidate`: Seconds a stale response may still be
+       served while the cache refetches it.
+     - `public`: Whether shared caches may store responses at all. Public
+       resources don't send `Vary: Authorization`, so everybody gets the
+       same cached copy: only use it for data that's the same for all.
+    """
+    CACHEABLE_METHODS = ('GET', 'HEAD')
+    CACHEABLE_STATUS = (200, 203, 300, 301, 304, 404, 410)
+    
+    def __init__(self, max_age=0, s_maxage=None, stale_while_revalidate=None, public=False):
+        self.max_age = max_age
+        self.s_maxage = s_maxage
+        self.stale_while_revalidate = stale_while_revalidate
+        self.public = public
+        
+    def cacheable(self, request, response):
+        return request.method.upper() in self.CACHEABLE_METHODS and \
+            response.status_code in self.CACHEABLE_STATUS
+        
+    def apply(self, request, response):
+        """
+        Sets `Cache-Control` and `Vary` on `response`.
+        """
+        if not self.public:
+            patch_vary_headers(response, ('Authorization',))
+        
+        if not self.cacheable(request, response):
+            add_never_cache_headers(response)
+            return response
+        
+        directives = { 'max_age': self.max_age }
+        if self.public:
+            directives['public'] = True
+        else:
+            directives['private'] = True
+        if self.s_maxage is not None and self.public:
+            directives['s_maxage'] = self.s_maxage
+        if self.stale_while_revalidate is not None:
+            directives['stale_while_revalidate'] = self.stale_while_revalidate
+        
+        patch_cache_control(response, **directives)
+        return response
+
+class NeverCache(CachePolicy):
+    """
+    The policy of resources registered without one: every
+    response is marked never-cache, and varies on `Authorization`.
+    """
+    def cacheable(self, request, response):
+        return False
+
+def model_version_key(model):
+    opts = model._meta
+    return 'fulcrum:version:%s.%s' % (opts.app_label, opts.model_name)
+
+def get_model_version(model):
+    """
+    Returns the current version of `model`'s data: a counter in
+    Django's cache, bumped on every change. Counters start from the
+    current time in milliseconds, so one that was evicted never
+    repeats a version handed out before.
+    
+    Needs a cache shared by all processes to be of any use.
+    """
+    key = model_version_key(model)
+    version = cache.get(key)
+    
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    
+    return version
+
+_warned_locmem = False
+
+def check_version_cache():
+    """
+    Checks the default cache can hold model versions for conditional
+    resources. `DummyCache` keeps nothing, so every ETag would match
+    forever: that's refused. `LocMemCache` keeps a counter per process,
+    so a change made in one is never seen by the others, which go on
+    answering 304s: fine for `runserver`, logged as a warning, once.
+    """
+    if isinstance(cache, DummyCache):
+        raise ImproperlyConfigured('Conditional resources need a cache to keep model versions '
+                                   'in, and the default cache is a DummyCache.')
+    
+    global _warned_locmem
+    if isinstance(cache, LocMemCache) and not _warned_locmem:
+        _warned_locmem = True
+        log.warning('Conditional resources keep model versions in the default cache, which is a '
+                    'LocMemCache: other processes will serve stale 304s. Use a shared cache.')
+
+def bump_model_version(model):
+    key = model_version_key(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000), None)
+
+def related_models(model, fields=()):
+    """
+    Returns the models whose data can show up nested in the output of
+    `model`: those it reaches through ForeignKey, OneToOne and ManyToMany
+    fields, directly or not, and the reverse relations named in `fields`
+    (a handler's `fields`). Sorted by label, `model` itself left out.
+    """
+    todo = [ model ]
+    
+    for name in fields:
+        if isinstance(name, (list, tuple)):
+            name = name[0]
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if field.auto_created and not field.concrete:
+            todo.append(field.related_model)
+    
+    seen = set()
+    while todo:
+        current = todo.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        todo.extend([ f.rel.to for f in current._meta.fields + current._meta.many_to_many
+                      if f.rel is not None ])
+    
+    seen.discard(model)
+    return sorted(seen, key=model_version_key)
+
+def track_changes(model):
+    """
+    Bumps the version of `model` whenever one of its rows is
+    saved or deleted, or its ManyToMany links change. Writes that
+    send no signals (`QuerySet.update`, `bulk_create`) have to
+    call `bump_model_version` themselves.
+    """
+    def changed(sender, **kwargs):
+        bump_model_version(model)
+    
+    uid = model_version_key(model)
+    post_save.connect(changed, sender=model, weak=False, dispatch_uid=uid + ':save')
+    post_delete.connect(changed, sender=model, weak=False, dispatch_uid=uid + ':delete')
+    
+    for f in model._meta.many_to_many:
+        m2m_changed.connect(changed, sender=f.rel.through, weak=False,
+                            dispatch_uid='%s:m2m:%s' % (uid, f.name))
+
+class BodySpool(object):
+    """
+    Keeps large rendered response bodies on disk, keyed on their entity
+    tag, so that repeat requests are served as files (see
+    `utils.file_response`) instead of being rendered again.
+    
+    Parameters::
+     - `root`: The directory, `FULCRUM_SPOOL_ROOT` by default, or a
+       `fulcrum-spool` directory in the system temp dir.
+     - `threshold`: Bodies shorter than this many bytes are left alone,
+       `FULCRUM_SPOOL_THRESHOLD` (1 MB) by default.
+     - `timeout`: Seconds a file is kept for, `FULCRUM_SPOOL_TIMEOUT`
+       (1 day) by default. Entity tags change with the data, so stale
+       files are never served, just left to expire.
+    """
+    def __init__(self, root=None, threshold=None, timeout=None):
+        self.root = root or getattr(settings, 'FULCRUM_SPOOL_ROOT',
+                                    os.path.join(tempfile.gettempdir(), 'fulcrum-spool'))
+        self.threshold = threshold or getattr(settings, 'FULCRUM_SPOOL_THRESHOLD', 1024*1024)
+        self.timeout = timeout or getattr(settings, 'FULCRUM_SPOOL_TIMEOUT', 60*60*24)
+        self._pruned = 0
+        
+    def path(self, key):
+        return os.path.join(self.root, hashlib.md5(key).hexdigest())
+        
+    def get(self, key):
+        """
+        Returns the path of the body spooled under `key`, or None.
+        """
+        path = self.path(key)
+        return os.path.exists(path) and path or None
+        
+    def put(self, key, content):
+        """
+        Spools `content` under `key` if it's at least `threshold` bytes
+        long. Returns the path it went to, or None.
+        """
+        if len(content) < self.threshold:
+            return None
+        
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass # already there
+        
+        # Write and rename, so readers never see half a file.
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp, self.path(key))
+        
+        self.prune()
+        return self.path(key)
+        
+    def prune(self):
+        """
+        Deletes expired files, at most every tenth of `timeout`.
+        """
+        now = time.time()
+        if now - self._pruned < self.timeout / 10:
+            return
+        self._pruned = now
+        
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) < now - self.timeout:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,74 @@
+"""
+Change tracking for the changes feed.
+
+Resources registered with `changes=True` log the primary key of every
+object saved or deleted, or whose ManyToMany links change, to the
+`Change` table. `<resource>/changes.<format>?since=<token>` then
+returns just the objects changed after `token`, tombstones for the
+ones since deleted, and the token to pass next time (see
+`BaseHandler.changes`). Start with `since=0`.
+
+Writes that send no signals (`QuerySet.update`, `bulk_create`) have to
+`record` their changes themselves; `DefaultHandler` does.
+"""
+
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+_tracked = set()
+
+def model_label(model):
+    opts = model._meta
+    return '%s.%s' % (opts.app_label, opts.model_name)
+
+def is_tracked(model):
+    return model in _tracked
+
+def record(model, pks):
+    """
+    Logs a change to the objects of `model` with primary keys `pks`.
+    """
+    # Imported here, as the package is imported before models are ready.
+    from fulcrum.models import Change
+    
+    label = model_label(model)
+    Change.objects.bulk_create([ Change(model=label, object_pk=unicode(pk)) for pk in pks ])
+
+def track(model):
+    """
+    Starts logging changes to `model`.
+    """
+    if model in _tracked:
+        return
+    _tracked.add(model)
+    
+    def changed(sender, instance, **kwargs):
+        record(model, [instance.pk])
+    
+    label = model_label(model)
+    post_save.connect(changed, sender=model, weak=False, dispatch_uid='fulcrum:changes:%s:save' % label)
+    post_delete.connect(changed, sender=model, weak=False, dispatch_uid='fulcrum:changes:%s:delete' % label)
+    
+    for f in model._meta.many_to_many:
+        m2m_changed.connect(links_changed(model, f), sender=f.rel.through, weak=False,
+                            dispatch_uid='fulcrum:changes:%s:m2m:%s' % (label, f.name))
+
+def links_changed(model, field):
+    """
+    Returns an `m2m_changed` receiver logging the objects of `model`
+    whose `field` links change, from either side of the relation.
+    """
+    through = field.rel.through
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    
+    def changed(sender, instance, action, reverse, pk_set, **kwargs):
+        if not reverse:
+            if action in ('post_add', 'post_remove', 'post_clear'):
+                record(model, [instance.pk])
+        elif action in ('post_add', 'post_remove'):
+            record(model, pk_set or ())
+        elif action == 'pre_clear':
+            # Afterwards there's no telling which objects were linked.
+            record(model, through._default_manager.filter(**{ target: instance })
+                                                  .values_list(source, flat=True))
+    
+    return changed
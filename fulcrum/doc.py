@@ -1,8 +1,11 @@
-import inspect, handler
+import inspect, handler, json
 
 from fulcrum.handler import typemapper
+from fulcrum.utils import get_etag
+from fulcrum import schemas
 
 from django.core.urlresolvers import get_resolver, get_callable, get_script_prefix
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
@@ -152,6 +155,66 @@ class HandlerDocumentation(object):
     def __repr__(self):
         return u'<Documentation for "%s">' % self.name
 
+class SiteDocumentation(object):
+    """
+    Machine-readable description of every resource registered
+    with a `FulcrumSite`: fields and types, allowed methods,
+    URL templates and authentication scheme, in one document.
+    
+    Built once and identified by a digest of its content, so
+    clients can cache it for as long as the digest holds.
+    """
+    def __init__(self, site):
+        self.site = site
+        self.data = self.build()
+        self.text = json.dumps(self.data, sort_keys=True, indent=4)
+        self.etag = get_etag(self.text)
+        self.digest = self.etag.strip('"')
+        
+    def get_prefix(self):
+        try:
+            return reverse('%s:fulcrum_index' % self.site.name)
+        except NoReverseMatch:
+            return u''
+        
+    def describe(self, resource, prefix):
+        authentication = resource.authentication
+        methods = resource.get_allowed_methods()
+        
+        if isinstance(methods, basestring):
+            methods = (methods,)
+        
+        data = {
+            'name': resource.name,
+            'verbose_name': unicode(resource.verbose_name),
+            'group': resource.group,
+            'arbitrary': resource.arbitrary,
+            'allowed_methods': list(methods),
+            'authentication': getattr(authentication, 'scheme', authentication.__class__.__name__),
+            'resource_uri_template': HandlerDocumentation(resource.handler).get_resource_uri_template(),
+            'urls': {
+                'collection': u'%s%s.{format}' % (prefix, resource.name),
+                'object': u'%s%s/{pk}.{format}' % (prefix, resource.name),
+            },
+        }
+        
+        if resource.arbitrary:
+            data['schema'] = resource.handler.data_schema()
+        else:
+            data['schema'] = schemas.JSONSchema(resource.model).data
+            data['urls']['schema'] = dict([ (f, u'%s%s' % (prefix, u)) 
+                for f, u in resource.schema_urls().items() ])
+        
+        return data
+        
+    def build(self):
+        prefix = self.get_prefix()
+        
+        return {
+            'name': self.site.name,
+            'resources': [ self.describe(r, prefix) for _, r in sorted(self.site.registry.items()) ],
+        }
+
 def documentation_view(request):
     """
     Generic documentation view. Generates documentation
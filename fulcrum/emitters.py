@@ -1,6 +1,6 @@
 from __future__ import generators
 
-import decimal, re, inspect, log
+import codecs, decimal, re, inspect, log
 
 try:
     # yaml isn't standard with python.  It shouldn't be required if it
@@ -23,12 +23,13 @@ from django.db.models.query import QuerySet
 from django.db.models import Model, permalink
 import json
 from django.utils.xmlutils import SimplerXMLGenerator
-from django.utils.encoding import smart_unicode
+from django.utils.encoding import smart_unicode, smart_str
 from django.core.serializers.json import DateTimeAwareJSONEncoder
 from django.http import HttpResponse
+from django.conf import settings
 from django.core import serializers
 
-from utils import HttpStatusCode, Mimer
+from utils import HttpStatusCode, Mimer, MimerDataException, RequestTooLarge, media_type, parse_accept
 
 try:
     import cStringIO as StringIO
@@ -49,6 +50,13 @@ class Emitter(object):
     emitter. See below for examples.
     """
     EMITTERS = { }
+    
+    # Bare media type -> format, precomputed from `EMITTERS` (plus
+    # the HTML pages) whenever an emitter is (un)registered, and the
+    # outcome of `negotiate` for each distinct `Accept` header seen.
+    MEDIA_TYPES = { 'text/html': 'html' }
+    NEGOTIATED = { }
+    NEGOTIATED_MAX_SIZE = 256
 
     def __init__(self, payload, recurse_level, typemapper, handler, fields=(), anonymous=True):
         self.typemapper = typemapper
@@ -313,6 +321,50 @@ class Emitter(object):
 
         raise ValueError("No emitters found for type %s" % format)
     
+    @classmethod
+    def negotiate(cls, accept):
+        """
+        Picks the format to answer an `Accept` header with, honouring
+        q-values. Returns None when anything goes (`*/*`) or nothing
+        offered is acceptable, leaving the choice to the caller.
+        """
+        try:
+            return cls.NEGOTIATED[accept]
+        except KeyError:
+            pass
+        
+        format = None
+        for mime, q in parse_accept(accept):
+            if mime in cls.MEDIA_TYPES:
+                format = cls.MEDIA_TYPES[mime]
+            elif mime.endswith('/*') and mime != '*/*':
+                matches = sorted([ m for m in cls.MEDIA_TYPES if m.startswith(mime[:-1]) ])
+                format = matches and cls.MEDIA_TYPES[matches[0]] or None
+            elif mime == '*/*':
+                break
+            if format is not None:
+                break
+        
+        # Headers come from clients, so don't let the memo grow unbounded.
+        if len(cls.NEGOTIATED) >= cls.NEGOTIATED_MAX_SIZE:
+            cls.NEGOTIATED.clear()
+        cls.NEGOTIATED[accept] = format
+        
+        return format
+    
+    @classmethod
+    def update_media_types(cls):
+        # Several emitters can share a content type (xml and django);
+        # the one registered first keeps it.
+        media_types = dict([ (mime, name) for mime, name in cls.MEDIA_TYPES.items()
+                             if name == 'html' or name in cls.EMITTERS
+                             and media_type(cls.EMITTERS[name][1]) == mime ])
+        for name, (klass, ct) in cls.EMITTERS.items():
+            media_types.setdefault(media_type(ct), name)
+        
+        cls.MEDIA_TYPES = media_types
+        cls.NEGOTIATED = { }
+    
     @classmethod
     def register(cls, name, klass, content_type='text/plain'):
         """
@@ -324,6 +376,7 @@ class Emitter(object):
          - `content_type`: The content type to serve response as.
         """
         cls.EMITTERS[name] = (klass, content_type)
+        cls.update_media_types()
         
     @classmethod
     def unregister(cls, name):
@@ -331,7 +384,9 @@ class Emitter(object):
         Remove an emitter from the registry. Useful if you don't
         want to provide output in one of the built-in emitters.
         """
-        return cls.EMITTERS.pop(name, None)
+        emitter = cls.EMITTERS.pop(name, None)
+        cls.update_media_types()
+        return emitter
     
 class XMLEmitter(Emitter):
     def _to_xml(self, xml, data):
@@ -361,6 +416,66 @@ class XMLEmitter(Emitter):
         xml.endDocument()
         
         return stream.getvalue()
+        
+    def stream_render(self, request):
+        """
+        Like `render`, but yields the document a top-level
+        resource at a time instead of building it whole.
+        """
+        stream = StringIO.StringIO()
+        
+        xml = SimplerXMLGenerator(stream, "utf-8")
+        xml.startDocument()
+        xml.startElement("response", {})
+        
+        data = self.construct()
+        
+        for item in (data if isinstance(data, (list, tuple)) else [data]):
+            if isinstance(data, (list, tuple)):
+                xml.startElement("resource", {})
+                self._to_xml(xml, item)
+                xml.endElement("resource")
+            else:
+                self._to_xml(xml, item)
+            
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+        
+        xml.endElement("response")
+        xml.endDocument()
+        
+        yield stream.getvalue()
+        
+    def render_chunk(self):
+        """
+        Renders the resources of a list payload without the enclosing
+        document, for `fulcrum.parallel` to `stitch` together.
+        """
+        stream = StringIO.StringIO()
+        self._to_xml(SimplerXMLGenerator(stream, "utf-8"), self.construct())
+        return stream.getvalue()
+        
+    @classmethod
+    def stitch(cls, chunks, request):
+        """
+        Yields a document made of chunks from `render_chunk`, in order.
+        """
+        stream = StringIO.StringIO()
+        xml = SimplerXMLGenerator(stream, "utf-8")
+        
+        xml.startDocument()
+        xml.startElement("response", {})
+        yield stream.getvalue()
+        
+        for chunk in chunks:
+            yield chunk
+        
+        stream.seek(0)
+        stream.truncate()
+        xml.endElement("response")
+        xml.endDocument()
+        yield stream.getvalue()
 
 Emitter.register('xml', XMLEmitter, 'text/xml; charset=utf-8')
 Mimer.register(lambda *a: None, ('text/xml',))
@@ -369,18 +484,185 @@ class JSONEmitter(Emitter):
     """
     JSON emitter, understands timestamps.
     """
+    # Bytes to collect from `iterencode` before yielding them.
+    chunk_size = 16 * 1024
+    
     def render(self, request):
+        # Joining the chunks copies the document once, where wrapping
+        # it in a callback with `%` took another full copy.
+        return ''.join(self.stream_render(request))
+        
+    def stream_render(self, request):
+        """
+        Like `render`, but encodes incrementally with `iterencode`,
+        yielding UTF-8 chunks of about `chunk_size` bytes.
+        """
         cb = request.GET.get('callback')
-        seria = simplejson.dumps(self.construct(), cls=DateTimeAwareJSONEncoder, ensure_ascii=False, indent=4)
-
-        # Callback
+        encoder = DateTimeAwareJSONEncoder(ensure_ascii=False, indent=4)
+        
         if cb:
-            return '%s(%s)' % (cb, seria)
-
-        return seria
+            yield smart_str(cb) + '('
+        
+        buf, size = [], 0
+        for piece in encoder.iterencode(self.construct()):
+            buf.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield smart_str(u''.join(buf))
+                buf, size = [], 0
+        
+        if buf:
+            yield smart_str(u''.join(buf))
+        
+        if cb:
+            yield ')'
+        
+    def render_chunk(self):
+        """
+        Renders the items of a list payload without the enclosing
+        brackets, for `fulcrum.parallel` to `stitch` together.
+        """
+        encoded = DateTimeAwareJSONEncoder(ensure_ascii=False, indent=4).encode(self.construct())
+        return smart_str(encoded.strip()[1:-1].strip())
+        
+    @classmethod
+    def stitch(cls, chunks, request):
+        """
+        Yields an array made of chunks from `render_chunk`, in order.
+        """
+        cb = request.GET.get('callback')
+        
+        if cb:
+            yield smart_str(cb) + '('
+        
+        yield '['
+        
+        first = True
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if not first:
+                yield ','
+            yield chunk
+            first = False
+        
+        yield ']'
+        
+        if cb:
+            yield ')'
     
 Emitter.register('json', JSONEmitter, 'application/json; charset=utf-8')
 Mimer.register(json.loads, ('application/json',))
+
+def ndjson_loads(data):
+    """
+    Loads newline-delimited JSON into a list of records.
+    """
+    return [ json.loads(line) for line in data.splitlines() if line.strip() ]
+
+Mimer.register(ndjson_loads, ('application/x-ndjson',))
+
+def json_stream(stream, chunk_size=64 * 1024):
+    """
+    Returns an iterator over the elements of a JSON array body, or None
+    if the body isn't an array, leaving it for the plain loader: a lone
+    object is a single create, not a bulk one.
+    """
+    head = ''
+    while not head.lstrip():
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        head += chunk
+    stream.unread(head)
+    
+    if not head.lstrip().startswith('['):
+        return None
+    
+    return json_array_stream(stream, chunk_size)
+
+def json_array_stream(stream, chunk_size=64 * 1024):
+    """
+    Yields the elements of a JSON array as they are read from `stream`,
+    keeping only the unparsed tail of the body in memory. A body that
+    isn't an array has nothing to stream, and yields its one value.
+    
+    An element that doesn't fit in the buffer is only parsed again
+    once the buffer has doubled, so big elements cost linear time.
+    One over `FULCRUM_MAX_BODY_SIZE` raises `RequestTooLarge`.
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    limit = getattr(settings, 'FULCRUM_MAX_BODY_SIZE', None)
+    buf, state, eof = u'', 'start', False
+    size = chunk_size
+    
+    while True:
+        buf = buf.lstrip()
+        
+        if buf and state == 'start':
+            if buf[0] != u'[':
+                try:
+                    yield json.loads(buf + decode(stream.read(), True))
+                except ValueError:
+                    raise MimerDataException
+                return
+            buf, state = buf[1:], 'first'
+            continue
+        
+        if buf and state in ('first', 'next') and buf[0] == u']':
+            if buf[1:].strip():
+                raise MimerDataException
+            return
+        
+        if buf and state == 'next':
+            if buf[0] != u',':
+                raise MimerDataException
+            buf, state = buf[1:], 'value'
+            continue
+        
+        if buf and state in ('first', 'value'):
+            try:
+                value, end = decoder.raw_decode(buf)
+            except ValueError:
+                pass
+            else:
+                if limit is not None and end > limit:
+                    raise RequestTooLarge
+                
+                # A value running to the end of the buffer may be cut
+                # short (think numbers), so wait for more unless done.
+                if end < len(buf) or eof:
+                    yield value
+                    buf, state, size = buf[end:], 'next', chunk_size
+                    continue
+            
+            # Incomplete: read as much again before the next try.
+            if limit is not None and len(buf) > limit:
+                raise RequestTooLarge
+            size = max(chunk_size, len(buf))
+        
+        if eof:
+            raise MimerDataException
+        
+        chunk = stream.read(size)
+        eof = not chunk
+        buf += decode(chunk, eof)
+
+def ndjson_stream(stream):
+    """
+    Yields the records of newline-delimited JSON as they are
+    read from `stream`, one line at a time.
+    """
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise MimerDataException
+
+Mimer.register_stream(json_stream, ('application/json',))
+Mimer.register_stream(ndjson_stream, ('application/x-ndjson',))
     
 class YAMLEmitter(Emitter):
     """
@@ -0,0 +1,179 @@
+"""
+Background export jobs.
+
+A full dump of a large resource can take minutes to render, longer
+than a web worker should be tied up and than most proxies wait. With
+`exports=True`, a resource takes a POST to `<resource>/export.<format>`
+instead: the export is queued on a local worker pool and a 202 points
+at its status URL, which in turn links the finished file once the
+worker has spooled it to disk.
+
+Job status and output live as files under `FULCRUM_EXPORT_ROOT`, so
+any process sharing that directory can report on and serve a job.
+Jobs run in the process that accepted them, though: one that dies
+leaves its jobs running forever, until they expire.
+"""
+
+import os, copy, json, time, uuid, tempfile, threading
+
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+from fulcrum import log
+from fulcrum.emitters import Emitter
+from fulcrum.handler import typemapper
+
+JOB_ID = r'[0-9a-f]{32}'
+
+class ExportManager(object):
+    """
+    Queues, runs and keeps track of export jobs.
+    
+    Parameters::
+     - `root`: The spool directory. Defaults to `FULCRUM_EXPORT_ROOT`,
+       or a `fulcrum-exports` directory in the system temp dir.
+     - `workers`: The size of the worker pool, `FULCRUM_EXPORT_WORKERS`
+       (2) by default. Workers are threads, started on first use.
+     - `timeout`: Seconds finished jobs are kept for,
+       `FULCRUM_EXPORT_TIMEOUT` (1 day) by default.
+    """
+    def __init__(self, root=None, workers=None, timeout=None):
+        self.root = root or getattr(settings, 'FULCRUM_EXPORT_ROOT',
+                                    os.path.join(tempfile.gettempdir(), 'fulcrum-exports'))
+        self.workers = workers or getattr(settings, 'FULCRUM_EXPORT_WORKERS', 2)
+        self.timeout = timeout or getattr(settings, 'FULCRUM_EXPORT_TIMEOUT', 60*60*24)
+        self._pool = None
+        self._lock = threading.Lock()
+    
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+    
+    def path(self, job_id, suffix):
+        return os.path.join(self.root, '%s.%s' % (job_id, suffix))
+    
+    def status(self, job_id):
+        """
+        Returns the status dict of a job, or None if there's no such job.
+        """
+        try:
+            with open(self.path(job_id, 'json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+    
+    def set_status(self, job_id, status):
+        # Write and rename, so readers never see half a file.
+        path = self.path(job_id, 'json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(status, f)
+        os.rename(path + '.tmp', path)
+    
+    def discard(self, job_id):
+        """
+        Forgets a job whose output went missing, deleting its status.
+        """
+        try:
+            os.remove(self.path(job_id, 'json'))
+        except OSError:
+            pass # already gone
+    
+    def submit(self, resource, request, handler, anonymous, format, filters):
+        """
+        Queues an export of `handler.read(request, **filters)` rendered
+        as `format`, and returns the new job's status dict.
+        """
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass # already there
+        self.prune()
+        
+        job_id = uuid.uuid4().hex
+        status = { 'id': job_id,
+                   'resource': resource.name,
+                   'format': format,
+                   'user': getattr(getattr(request, 'user', None), 'pk', None),
+                   'status': 'queued',
+                   'created': time.time() }
+        
+        self.set_status(job_id, status)
+        self.pool.apply_async(self.run, (job_id, status, request, handler, anonymous, filters))
+        
+        return status
+    
+    def run(self, job_id, status, request, handler, anonymous, filters):
+        """
+        Runs a job on a worker: reads the data, streams it through the
+        emitter into a part file, and renames that into place when done.
+        """
+        output = self.path(job_id, status['format'])
+        
+        status = dict(status, status='running', started=time.time())
+        self.set_status(job_id, status)
+        
+        try:
+            result = handler.read(request, **filters)
+            if isinstance(result, HttpResponse):
+                raise ValueError('The handler returned %d.' % result.status_code)
+            
+            emitter, content_type = Emitter.get(status['format'])
+            srl = emitter(result, 0, typemapper, handler, handler.fields, anonymous)
+            
+            with open(output + '.part', 'wb') as f:
+                for chunk in srl.stream_render(request):
+                    f.write(chunk if isinstance(chunk, str) else chunk.encode('utf-8'))
+            os.rename(output + '.part', output)
+            
+            status.update(status='done', finished=time.time(),
+                          size=os.path.getsize(output), content_type=content_type)
+        except Exception, e:
+            log.error('export %s: %s' % (job_id, e))
+            status.update(status='failed', finished=time.time(), error=str(e))
+        finally:
+            for connection in connections.all():
+                connection.close()
+        
+        self.set_status(job_id, status)
+    
+    def prune(self):
+        """
+        Deletes the files of jobs older than `timeout`.
+        """
+        if not os.path.isdir(self.root):
+            return
+        
+        expired = time.time() - self.timeout
+        
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+    
+    @staticmethod
+    def snapshot(request):
+        """
+        A copy of `request` for a worker to render with, after
+        the view that queued the job has returned.
+        """
+        snapshot = copy.copy(request)
+        snapshot.GET = request.GET.copy()
+        snapshot.META = request.META.copy()
+        return snapshot
+
+_manager = None
+
+def get_export_manager():
+    global _manager
+    if _manager is None:
+        _manager = ExportManager()
+    return _manager
@@ -1,9 +1,18 @@
-from utils import rc
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError
-from django.db.models import ForeignKey, ManyToManyField
+import json
+
+from utils import rc, chunked, HttpStatusCode
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError, FieldError
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import ManyToManyField, FieldDoesNotExist, Q, Max, Min, Sum, Avg, Count
+from django.utils import timezone
 #from django.contrib.auth.models import User
 from django.http import HttpResponse, HttpResponseBadRequest
-from fulcrum import log, schemas
+from fulcrum import log, schemas, changes, lookups
+from fulcrum.validators import get_validator
+from fulcrum.caching import bump_model_version
+
+AGGREGATES = { 'count': Count, 'sum': Sum, 'avg': Avg, 'min': Min, 'max': Max }
 
 typemapper = { }
 
@@ -32,14 +41,41 @@ class BaseHandler(object):
     """
     __metaclass__ = HandlerMetaClass
     
-    allowed_methods = ('GET', 'POST', 'PUT', 'DELETE')
+    allowed_methods = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
     anonymous = is_anonymous = False
     exclude = ( 'id', )
     fields =  ( )
+    natural_key = ( )
+    # The filters list requests take, spelled like `bulk_delete_filters`.
+    # None allows exact lookups on any indexed field. See `clean_filters`.
+    filter_fields = None
+    bulk_delete_filters = ( )
+    bulk_delete_chunk_size = None
+    # Filters a PUT or PATCH without a primary key may update by. Off
+    # unless listed, like `bulk_delete_filters`.
+    bulk_update_filters = ( )
+    # Set to have JSON array and NDJSON POST bodies handed over as an
+    # iterator on `request.data_stream`, read as it's consumed.
+    stream_input = False
+    # An indexed date/time field kept current on every save, such as
+    # `updated_at`, for the `Last-Modified` of conditional resources.
+    last_modified_field = None
+    # Fields list requests can `?aggregate=` over, and `?group_by=`.
+    # None for `group_by_fields` allows any indexed field.
+    aggregate_fields = ( )
+    group_by_fields = None
     
     def flatten_dict(self, dct):
         return dict([ (str(k), dct.getlist(k)) for k in dct.keys() ])
     
+    def queryset(self, request):
+        """
+        The objects `request` may read. `read`, `last_modified` and the
+        changes feed all start from here, so override it to scope
+        what a user sees, by `request.user` and such.
+        """
+        return self.model.objects.all()
+    
     def has_model(self):
         return hasattr(self, 'model')
     
@@ -59,21 +95,224 @@ class BaseHandler(object):
         except self.model.DoesNotExist:
             return False
     
+    def is_duplicate(self, attrs):
+        """
+        Checks whether an object with the same `natural_key` as
+        `attrs` already exists. `natural_key` names the fields that
+        make an object unique, and should be backed by an index:
+        
+            natural_key = ('slug',)
+        
+        Without one, duplicates are left to the database's unique
+        constraints, which `create` catches on insert.
+        """
+        if not self.natural_key:
+            return False
+        
+        try:
+            lookup = dict([ (k, attrs[k]) for k in self.natural_key ])
+        except KeyError:
+            return False
+        
+        return self.model.objects.filter(**lookup).exists()
+    
+    def clean_filters(self, filters, allowed=None):
+        """
+        Checks the filters in `filters` against `allowed`, by default
+        `filter_fields`, and returns them with their values coerced
+        through the model fields. Filters are lookups, and leaving out
+        the lookup means exact:
+        
+            filter_fields = ('author', 'created__gte', 'status__in')
+        
+        Lookups may follow relations ('author__name'), but only when
+        listed. With `filter_fields` None, exact lookups on indexed
+        fields are allowed; on the primary key, they always are.
+        
+        Raises `HttpStatusCode` with a 400 for filters that aren't
+        allowed or values that don't fit.
+        """
+        if allowed is None:
+            allowed = self.filter_fields
+        if allowed is not None:
+            allowed = set([ lookups.normalize(key) for key in allowed ])
+        
+        pkname = self.model._meta.pk.name
+        indexed = None
+        cleaned = {}
+        
+        for key, value in filters.items():
+            try:
+                field, lookup = lookups.resolve(self.model, key)
+            except ValueError, e:
+                raise HttpStatusCode(HttpResponseBadRequest(str(e)))
+            
+            if key in ('pk', pkname, 'pk__exact', pkname + '__exact'):
+                pass
+            elif allowed is not None:
+                if lookups.normalize(key) not in allowed:
+                    raise HttpStatusCode(HttpResponseBadRequest('Can not filter on %s. Filters are: %s.'
+                                                                % (key, ', '.join(sorted(allowed)) or 'none')))
+            else:
+                if indexed is None:
+                    indexed = schemas.indexed_fields(self.model)
+                path = lookups.split(key)[0]
+                if lookup != 'exact' or len(path) > 1 or path[0] not in indexed:
+                    raise HttpStatusCode(HttpResponseBadRequest('Can not filter on %s. Filters are exact matches on: %s.'
+                                                                % (key, ', '.join(sorted(indexed)))))
+            
+            try:
+                cleaned[key] = lookups.coerce(field, lookup, value)
+            except ValidationError, e:
+                raise HttpStatusCode(HttpResponseBadRequest('%s: %s' % (key, '; '.join(e.messages))))
+        
+        return cleaned
+    
     def read(self, request, *args, **kwargs):
         if not self.has_model():
             return rc.NOT_IMPLEMENTED
+        
+        kwargs = self.clean_filters(kwargs)
 
         pkfield = self.model._meta.pk.name
 
         if pkfield in kwargs:
             try:
-                return self.model.objects.get(pk=kwargs.get(pkfield))
+                return self.queryset(request).get(pk=kwargs.get(pkfield))
             except ObjectDoesNotExist:
                 return rc.NOT_FOUND
             except MultipleObjectsReturned: # should never happen, since we're using a PK
                 return rc.BAD_REQUEST
         else:
-            return self.model.objects.filter(*args, **kwargs)
+            return self.queryset(request).filter(*args, **kwargs)
+    
+    def last_modified(self, request, *args, **kwargs):
+        """
+        Returns the `last_modified_field` value of the object `read`
+        would return, or None. Lists get None: deletions don't show up
+        in the latest value of a list, so it can't back `If-Modified-Since`.
+        """
+        if not self.has_model() or not self.last_modified_field:
+            return None
+        
+        pkfield = self.model._meta.pk.name
+        
+        if pkfield not in kwargs and 'pk' not in kwargs:
+            return None
+        
+        try:
+            kwargs = self.clean_filters(kwargs)
+            if pkfield in kwargs:
+                queryset = self.queryset(request).filter(pk=kwargs.get(pkfield))
+            else:
+                queryset = self.queryset(request).filter(*args, **kwargs)
+            return queryset.aggregate(latest=Max(self.last_modified_field))['latest']
+        except (FieldError, ValueError, ValidationError, HttpStatusCode):
+            # Leave bad filters for `read` to report.
+            return None
+    
+    def changes(self, request, *args, **kwargs):
+        """
+        The changes feed of a resource registered with `changes=True`.
+        Returns the objects saved after the token `?since=` (0 for
+        everything still logged), the primary keys of those deleted
+        since, and the token to ask with next time. `more` is set if
+        the feed was cut short at `?limit=` entries, in which case
+        ask again straight away.
+        
+        A token older than the log (see `prune_changes`) gets a 410:
+        the client has to fetch the resource in full and start over.
+        Objects come from `queryset`: those the user can't read are
+        left out, and not reported as deleted either.
+        Changes only show up `FULCRUM_CHANGES_SETTLE` seconds (5)
+        after they're logged, see `ChangeManager.feed`.
+        """
+        from fulcrum.models import Change
+        
+        if not self.has_model():
+            return rc.NOT_IMPLEMENTED
+        
+        max_limit = getattr(settings, 'FULCRUM_CHANGES_LIMIT', 500)
+        
+        try:
+            since = int(request.GET.get('since', 0))
+            limit = min(int(request.GET.get('limit', max_limit)), max_limit)
+        except ValueError:
+            return HttpResponseBadRequest('since and limit take integers.')
+        
+        if since < 0 or limit < 1:
+            return HttpResponseBadRequest('since and limit take positive integers.')
+        
+        feed = Change.objects.feed(changes.model_label(self.model), since, limit,
+                                   getattr(settings, 'FULCRUM_CHANGES_SETTLE', 5))
+        if feed is None:
+            resp = rc.NOT_HERE
+            resp.write(' The changes since %d have expired.' % since)
+            return resp
+        
+        pks, token, more = feed
+        
+        to_python = self.model._meta.pk.to_python
+        pks = [ to_python(pk) for pk in pks ]
+        objs = self.queryset(request).in_bulk(pks)
+        
+        missing = [ pk for pk in pks if pk not in objs ]
+        if missing:
+            hidden = set(self.model._default_manager.filter(pk__in=missing).values_list('pk', flat=True))
+            missing = [ pk for pk in missing if pk not in hidden ]
+        
+        return { 'changes': [ objs[pk] for pk in pks if pk in objs ],
+                 'deleted': missing,
+                 'token': token,
+                 'more': more }
+    
+    def summarize(self, request, queryset):
+        """
+        Answers list requests asking for a summary instead of the rows
+        `queryset` holds, each with a single query:
+        
+            ?count=1                        { "count": 12 }
+            ?aggregate=sum:price,max:price  { "price__sum": 340, "price__max": 99 }
+            ?aggregate=avg:price&group_by=category
+                                            [ { "category": 1, "count": 5, "price__avg": 20 }, ... ]
+        
+        The functions are count, sum, avg, min and max, over the fields
+        in `aggregate_fields`. Groups come with their row count, and can
+        be taken on the fields in `group_by_fields`, by default any
+        indexed field. Returns `queryset` itself if no summary was asked.
+        """
+        count = request.GET.get('count', '0').lower() not in ('0', 'false', '')
+        aggregate = request.GET.get('aggregate', '')
+        group_by = request.GET.get('group_by', '')
+        
+        if not (count or aggregate or group_by):
+            return queryset
+        
+        aggregates = {}
+        for spec in filter(None, aggregate.split(',')):
+            function, _, name = spec.partition(':')
+            if function not in AGGREGATES or name not in self.aggregate_fields:
+                return HttpResponseBadRequest('Aggregates take <function>:<field>, with a function of %s and a field of %s.'
+                                              % (', '.join(sorted(AGGREGATES)), ', '.join(self.aggregate_fields) or 'none'))
+            aggregates['%s__%s' % (name, function)] = AGGREGATES[function](name)
+        
+        group_by = filter(None, group_by.split(','))
+        if group_by:
+            allowed = self.group_by_fields
+            if allowed is None:
+                allowed = schemas.indexed_fields(self.model)
+            disallowed = [ field for field in group_by if field not in allowed ]
+            if disallowed:
+                return HttpResponseBadRequest('Can not group by %s.' % ', '.join(disallowed))
+            
+            aggregates['count'] = Count('pk')
+            # Ordering on anything else would split the groups.
+            return list(queryset.values(*group_by).annotate(**aggregates).order_by(*group_by))
+        
+        if count:
+            aggregates['count'] = Count('pk')
+        
+        return queryset.aggregate(**aggregates)
     
     def create(self, request, *args, **kwargs):
         if not self.has_model():
@@ -81,15 +320,16 @@ class BaseHandler(object):
         
         attrs = self.flatten_dict(request.POST)
         
-        try:
-            inst = self.model.objects.get(**attrs)
+        if self.is_duplicate(attrs):
             return rc.DUPLICATE_ENTRY
-        except self.model.DoesNotExist:
-            inst = self.model(**attrs)
-            inst.save()
-            return inst
-        except self.model.MultipleObjectsReturned:
+        
+        inst = self.model(**attrs)
+        try:
+            with transaction.atomic():
+                inst.save()
+        except IntegrityError:
             return rc.DUPLICATE_ENTRY
+        return inst
     
     def update(self, request, *args, **kwargs):
         # TODO: This doesn't work automatically yet.
@@ -98,6 +338,11 @@ class BaseHandler(object):
     def delete(self, request, *args, **kwargs):
         if not self.has_model():
             raise NotImplementedError
+        
+        if self.bulk_delete_filters and not (self.model._meta.pk.name in kwargs or 'pk' in kwargs):
+            return self.bulk_delete(request, *args, **kwargs)
+        
+        kwargs = self.clean_filters(kwargs)
 
         try:
             inst = self.model.objects.get(*args, **kwargs)
@@ -110,6 +355,50 @@ class BaseHandler(object):
         except self.model.DoesNotExist:
             return rc.NOT_HERE
         
+    def bulk_delete(self, request, *args, **kwargs):
+        """
+        Deletes every object matching the filter in `kwargs` without
+        loading them one by one. Opt in by listing the allowed filter
+        lookups in `bulk_delete_filters`, e.g.:
+        
+            bulk_delete_filters = ('author', 'created_on__lt')
+        
+        Every filter used must be in that list, and at least one must be
+        given. Pass `?dry_run=1` to get the number of matching objects
+        without deleting anything.
+        
+        If `bulk_delete_chunk_size` is set, objects are deleted that many
+        at a time, each chunk in its own transaction, so huge deletes
+        don't hold locks for long. Returns the number of objects deleted.
+        """
+        disallowed = [ k for k in kwargs.keys() if k not in self.bulk_delete_filters ]
+        
+        if args or not kwargs or disallowed:
+            return HttpResponseBadRequest('Bulk delete requires a filter on: %s.' 
+                                          % ', '.join(self.bulk_delete_filters))
+        
+        queryset = self.model.objects.filter(**self.clean_filters(kwargs, self.bulk_delete_filters))
+        
+        if request.GET.get('dry_run', '0').lower() not in ('0', 'false', ''):
+            return { 'count': queryset.count(), 'dry_run': True }
+        
+        if not self.bulk_delete_chunk_size:
+            with transaction.atomic():
+                deleted = queryset.count()
+                queryset.delete()
+            return { 'deleted': deleted }
+        
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                pks = list(queryset.values_list('pk', flat=True)[:self.bulk_delete_chunk_size])
+                if not pks:
+                    break
+                self.model.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+        
+        return { 'deleted': deleted }
+        
 class AnonymousBaseHandler(BaseHandler):
     """
     Anonymous handler.
@@ -124,6 +413,7 @@ class DefaultHandler(BaseHandler):
     __metaclass__ = HandlerMetaClass
     
     anonymous = 'DefaultAnonymousHandler'
+    bulk_batch_size = 500
     
     def __init__(self, model):
         self.model = model
@@ -132,94 +422,426 @@ class DefaultHandler(BaseHandler):
     
     def create(self, request, *args, **kwargs):
         """
-        Default create implementation. Will only validate if all required fields are supplied.
+        Default create implementation. The payload is checked by the model's compiled
+        validator (see `fulcrum.validators`), so all required fields must be supplied.
         Related object fields require a primary_key to an object or list of objects that already
         exist in the database.
+        
+        A JSON array (or NDJSON) body creates many objects at once, see `bulk_create`.
+        With `stream_input` set, those bodies are read from `request.data_stream`
+        one batch at a time. A lone JSON object always creates just the one.
         """
         log.debug('create()')
         
         if not self.has_model():
             return rc.NOT_IMPLEMENTED
         
-        attrs = self.flatten_dict(request.POST)
-        for k in attrs.keys():
-            if len(attrs[k]) == 1:
-                attrs[k] = attrs[k][0]
+        if getattr(request, 'data_stream', None) is not None:
+            return self.bulk_create(request, request.data_stream)
+        
+        data = getattr(request, 'data', None)
+        
+        if isinstance(data, list):
+            return self.bulk_create(request, data)
+        
+        if isinstance(data, dict):
+            attrs = data
+        else:
+            attrs = self.flatten_dict(request.POST)
+            for k in attrs.keys():
+                if len(attrs[k]) == 1:
+                    attrs[k] = attrs[k][0]
+        
+        validator = get_validator(self.model)
+        attrs, errors = validator.validate(attrs)
+        if errors:
+            error_msg = ' '.join(errors)
+            log.debug(error_msg)
+            return HttpResponseBadRequest(error_msg)
         
         m2mobjs = {}
-        for f in self.model._meta.local_fields + self.model._meta.many_to_many:
+        for f in validator.related:
+            if attrs.get(f.name) is None:
+                continue
             
-            required = f.blank == False
-            if required and f.name in attrs:
+            if isinstance(f, ManyToManyField):
+                pks = set(attrs.pop(f.name)) # passing this into model(**attrs) throws an error
+                m2mobjs[f.name] = list(f.rel.to._default_manager.filter(pk__in=pks))
                 
-                if type(f) == ForeignKey:
-                    try:
-                        obj = f.rel.to.objects.get(pk=attrs[f.name])
-                        attrs[f.name] = obj
-                    except ObjectDoesNotExist, e:
-                        error_msg = 'ObjectDoesNotExist: %s' % e
-                        log.debug(error_msg)
-                        return HttpResponseBadRequest(error_msg)
-                elif type(f) == ManyToManyField:
-                    try:
-                        m2mobjs[f.name] = f.rel.to.objects.filter(pk__in=attrs[f.name])
-                                  
-                        if len(m2mobjs[f.name]) != len(attrs[f.name]):
-                            error_msg = 'ObjectDoesNotExist: A ManyToMany primary_key value failed to return an object.'
-                            log.debug(error_msg)
-                            return HttpResponseBadRequest(error_msg)
-                        del attrs[f.name] # passing this into model(**attrs) throws an error
-                    except ObjectDoesNotExist, e:
-                        error_msg = 'ObjectDoesNotExist: %s' % e
-                        log.debug(error_msg)
-                        return HttpResponseBadRequest(error_msg)
-            elif required and f.name not in attrs:
-                error_msg = 'Required field %s not found.' % f.name
-                log.debug(error_msg)
-                return HttpResponseBadRequest(error_msg)
+                if len(m2mobjs[f.name]) != len(pks):
+                    error_msg = 'ObjectDoesNotExist: A ManyToMany primary_key value failed to return an object.'
+                    log.debug(error_msg)
+                    return HttpResponseBadRequest(error_msg)
+            else:
+                try:
+                    key = f.rel.get_related_field().name
+                    attrs[f.name] = f.rel.to._default_manager.get(**{ key: attrs[f.name] })
+                except ObjectDoesNotExist, e:
+                    error_msg = 'ObjectDoesNotExist: %s' % e
+                    log.debug(error_msg)
+                    return HttpResponseBadRequest(error_msg)
+        
+        if self.is_duplicate(attrs):
+            return rc.DUPLICATE_ENTRY
         
+        # Fields are already clean and uniqueness is left to the
+        # database, so only the model's own clean() is left to run.
+        inst = self.model(**attrs)
         try:
-            inst = self.model.objects.get(**attrs)
+            inst.clean()
+        except ValidationError, e:
+            error_msg = str(e)
+            log.debug(error_msg)
+            return HttpResponseBadRequest(error_msg)
+        
+        # M2M links don't touch the instance's own fields, so
+        # adding them can't make it invalid; no second clean.
+        try:
+            with transaction.atomic():
+                inst.save()
+                for k, objs in m2mobjs.items():
+                    getattr(inst, k).add(*objs)
+        except IntegrityError:
             return rc.DUPLICATE_ENTRY
-        except self.model.DoesNotExist:
+        
+        return inst
+        
+    
+    
+    def bulk_create(self, request, rows):
+        """
+        Creates an object for every dict in `rows`, all in one transaction.
+        `rows` can be any iterable, and is only read a batch at a time.
+        
+        Rows are validated `bulk_batch_size` at a time. Related object fields
+        take primary keys, which are resolved with one `in_bulk` per related
+        model and batch. Objects are inserted with `bulk_create`, and the
+        ManyToMany links of a batch with one insert per through table.
+        
+        Rows clashing on `natural_key`, with the database or each other, fail
+        as duplicates; that check costs one query per batch.
+        
+        If any row fails, nothing is saved and a 400 lists the errors by row
+        index. On success, returns the number of objects created.
+        """
+        log.debug('bulk_create()')
+        
+        errors = []
+        created = 0
+        
+        try:
+            with transaction.atomic():
+                for number, batch in enumerate(chunked(rows, self.bulk_batch_size)):
+                    created += self.bulk_create_batch(batch, number * self.bulk_batch_size, errors)
+                if errors:
+                    transaction.set_rollback(True)
+        except IntegrityError, e:
+            error_msg = 'IntegrityError: %s' % e
+            log.debug(error_msg)
+            resp = rc.DUPLICATE_ENTRY
+            resp.content = error_msg
+            return resp
+        
+        if errors:
+            return HttpResponseBadRequest(json.dumps({ 'errors': errors }),
+                                          content_type='application/json; charset=utf-8')
+        
+        # bulk_create sends no signals, see `fulcrum.caching.track_changes`.
+        bump_model_version(self.model)
+        
+        return { 'created': created }
+    
+    def bulk_create_batch(self, rows, offset, errors):
+        """
+        Validates and, if no row so far has failed, inserts one batch of
+        `bulk_create`. Failures are appended to `errors`. Returns the number
+        of objects inserted.
+        """
+        validator = get_validator(self.model)
+        m2ms = list(self.model._meta.many_to_many)
+        
+        cleaned = []
+        for i, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append({ 'index': offset + i, 'error': 'Expected an object.' })
+                continue
+            
+            attrs, row_errors = validator.validate(row)
+            if row_errors:
+                error = ' '.join(row_errors)
+                log.debug(error)
+                errors.append({ 'index': offset + i, 'error': error })
+                continue
+            
+            cleaned.append((offset + i, attrs))
+        
+        # Resolve every related key in the batch, one query per field.
+        related = {}
+        for f in validator.related:
+            keys = set()
+            for index, attrs in cleaned:
+                value = attrs.get(f.name)
+                if value is not None:
+                    keys.update(value if isinstance(f, ManyToManyField) else [value])
+            
+            related[f.name] = {}
+            if keys:
+                key = f.rel.get_related_field().name
+                for obj in f.rel.to._default_manager.filter(**{ key + '__in': list(keys) }):
+                    related[f.name][getattr(obj, key)] = obj
+        
+        valid = []
+        for index, attrs in cleaned:
+            links, error = {}, None
+            
+            for f in validator.related:
+                value = attrs.get(f.name)
+                if value is None:
+                    continue
+                
+                if isinstance(f, ManyToManyField):
+                    del attrs[f.name]
+                    if not getattr(self.model, f.name).through._meta.auto_created:
+                        error = 'Cannot set %s, it uses a custom through model.' % f.name
+                        break
+                    objs = [ related[f.name].get(pk) for pk in value ]
+                    if None in objs:
+                        error = 'ObjectDoesNotExist: A ManyToMany primary_key value failed to return an object.'
+                        break
+                    links[f.name] = dict([ (obj.pk, obj) for obj in objs ]).values()
+                else:
+                    attrs[f.name] = related[f.name].get(value)
+                    if attrs[f.name] is None:
+                        error = 'ObjectDoesNotExist: No %s with primary_key %s.' % (f.name, value)
+                        break
+            
+            if error is None:
+                inst = self.model(**attrs)
+                try:
+                    inst.clean()
+                except ValidationError, e:
+                    error = str(e)
+            
+            if error is not None:
+                log.debug(error)
+                errors.append({ 'index': index, 'error': error })
+                continue
+            
+            valid.append((index, inst, links))
+        
+        if self.natural_key and valid:
+            duplicates = self.find_duplicates([ entry[1] for entry in valid ])
+            for index, inst, links in valid:
+                if inst in duplicates:
+                    errors.append({ 'index': index, 'error': 'Conflict/Duplicate' })
+        
+        if errors:
+            return 0
+        
+        # Without ids back from the insert, objects with links, or of a
+        # tracked model, have to be saved one by one to learn their
+        # primary key. Saving logs their change, too.
+        returns_ids = getattr(connection.features, 'can_return_ids_from_bulk_insert', False)
+        tracked = changes.is_tracked(self.model)
+        
+        inserted = self.model._default_manager.bulk_create([ inst for index, inst, links in valid 
+                                                             if returns_ids or not (links or tracked) ])
+        
+        for index, inst, links in valid:
+            if not returns_ids and (links or tracked):
+                inst.save()
+        
+        if tracked and returns_ids:
+            changes.record(self.model, [ inst.pk for inst in inserted ])
+        
+        for f in m2ms:
+            through = getattr(self.model, f.name).through
+            source, target = f.m2m_field_name(), f.m2m_reverse_field_name()
             
-            # instantiate model and validate
-            inst = self.model(**attrs)
+            through._default_manager.bulk_create([ through(**{ source: inst, target: obj })
+                for index, inst, links in valid for obj in links.get(f.name, ()) ])
+        
+        return len(valid)
+    
+    def find_duplicates(self, instances):
+        """
+        Returns the instances whose `natural_key` is already taken, either
+        in the database or by an earlier instance in the list. Costs one query.
+        """
+        attnames = [ self.model._meta.get_field(k).attname for k in self.natural_key ]
+        key = lambda inst: tuple([ getattr(inst, a) for a in attnames ])
+        
+        lookup = Q()
+        for inst in instances:
+            lookup |= Q(**dict(zip(attnames, key(inst))))
+        
+        existing = set(self.model.objects.filter(lookup).values_list(*attnames))
+        seen = set()
+        duplicates = []
+        
+        for inst in instances:
+            if key(inst) in existing or key(inst) in seen:
+                duplicates.append(inst)
+            seen.add(key(inst))
+        
+        return duplicates
+    
+    def update(self, request, *args, **kwargs):
+        """
+        Default update implementation for PUT and PATCH. Both are partial: only the
+        submitted fields are validated and written.
+        
+        With a primary key, updates that object and saves just the fields whose
+        value changed (`save(update_fields=...)`). Related object fields take a
+        primary_key, or a list of them for ManyToMany fields.
+        
+        Without one, the remaining keyword arguments are a filter, and the submitted
+        values are applied to every matching row with a single `QuerySet.update()`.
+        Opt in by listing the allowed filter lookups in `bulk_update_filters`.
+        ManyToMany fields can't be set this way. Returns the number of rows updated.
+        """
+        log.debug('update()')
+        
+        if not self.has_model():
+            return rc.NOT_IMPLEMENTED
+        
+        data = getattr(request, 'data', None)
+        
+        if data is None:
+            attrs = self.flatten_dict(request.PUT)
+            for k in attrs.keys():
+                if len(attrs[k]) == 1:
+                    attrs[k] = attrs[k][0]
+        elif isinstance(data, dict):
+            attrs = data
+        else:
+            return HttpResponseBadRequest('Expected an object of field values.')
+        
+        if not attrs:
+            return HttpResponseBadRequest('No fields to update.')
+        
+        opts = self.model._meta
+        fields = {}
+        
+        for name in attrs.keys():
+            try:
+                f = opts.get_field(name)
+            except FieldDoesNotExist:
+                return HttpResponseBadRequest('Unknown field %s.' % name)
+            if f.auto_created and not f.concrete:
+                return HttpResponseBadRequest('The reverse relation %s can not be updated.' % name)
+            if f.primary_key:
+                return HttpResponseBadRequest('The primary key %s can not be updated.' % name)
+            fields[name] = f
+        
+        pk = kwargs.pop(opts.pk.name, kwargs.pop('pk', None))
+        
+        if pk is not None:
+            return self.update_object(pk, attrs, fields)
+        
+        disallowed = [ k for k in kwargs.keys() if k not in self.bulk_update_filters ]
+        
+        if not self.bulk_update_filters:
+            return HttpResponseBadRequest('Updating requires a primary key.')
+        
+        if args or not kwargs or disallowed:
+            return HttpResponseBadRequest('Updating without a primary key requires a filter on: %s.'
+                                          % ', '.join(self.bulk_update_filters))
+        
+        kwargs = self.clean_filters(kwargs, self.bulk_update_filters)
+        
+        values = {}
+        
+        for name, f in fields.items():
+            if isinstance(f, ManyToManyField):
+                return HttpResponseBadRequest('ManyToMany field %s can only be set on a single object.' % name)
             try:
-                inst.full_clean()
+                values[f.attname] = f.clean(attrs[name], None)
             except ValidationError, e:
-                error_msg = str(e)
-                log.debug(error_msg)
-                return HttpResponseBadRequest(error_msg)
-            inst.save()
+                return HttpResponseBadRequest('%s: %s' % (name, '; '.join(e.messages)))
+        
+        # `QuerySet.update()` skips `pre_save`, so fill in auto_now fields here.
+        now = timezone.now()
+        for f in opts.local_fields:
+            if getattr(f, 'auto_now', False) and f.attname not in values:
+                values[f.attname] = f.to_python(now)
+        
+        queryset = self.model.objects.filter(*args, **kwargs)
+        
+        if changes.is_tracked(self.model):
+            # A batch at a time, to log just the rows updated. The
+            # batches stay under SQLite's 999 variable limit.
+            updated = 0
+            with transaction.atomic():
+                for pks in chunked(queryset.values_list('pk', flat=True).iterator(), 500):
+                    updated += self.model.objects.filter(pk__in=pks).update(**values)
+                    changes.record(self.model, pks)
+        else:
+            updated = queryset.update(**values)
+        
+        # Neither does QuerySet.update().
+        bump_model_version(self.model)
+        
+        return { 'updated': updated }
+    
+    def update_object(self, pk, attrs, fields):
+        """
+        Updates a single object for `update`.
+        """
+        try:
+            inst = self.model.objects.get(pk=pk)
+        except self.model.DoesNotExist:
+            return rc.NOT_FOUND
+        
+        changed = []
+        m2m = {}
+        
+        for name, f in fields.items():
+            if isinstance(f, ManyToManyField):
+                values = attrs[name]
+                if not isinstance(values, (list, tuple)):
+                    values = [values]
+                objs = f.rel.to._default_manager.filter(pk__in=values)
+                if len(objs) != len(set(values)):
+                    return HttpResponseBadRequest('ObjectDoesNotExist: A ManyToMany primary_key value failed to return an object.')
+                m2m[name] = objs
+                continue
             
-            # add M2M related field objs
-            if len(m2mobjs):
-                for k, v in m2mobjs.items():
-                    #log.debug('k:v = {0}:{1}'.format(k, v))
-                    f = getattr(inst, k)
-                    for val in v:
-                        try:
-                            f.add(val)
-                            inst.save()
-                        except:
-                            error_msg = 'Error adding %s to %s %s field' % (val, inst, f)
-                            log.debug(error_msg)
-                            return HttpResponseBadRequest(error_msg)
+            try:
+                value = f.to_python(attrs[name])
+            except ValidationError, e:
+                return HttpResponseBadRequest('%s: %s' % (name, '; '.join(e.messages)))
             
+            if getattr(inst, f.attname) != value:
+                setattr(inst, f.attname, value)
+                changed.append(name)
+        
+        if changed:
+            unchanged = [ f.name for f in self.model._meta.fields if f.name not in changed ]
             try:
-                # validate once more...
-                inst.full_clean()
+                inst.clean_fields(exclude=unchanged)
+                inst.clean()
             except ValidationError, e:
                 error_msg = str(e)
                 log.debug(error_msg)
                 return HttpResponseBadRequest(error_msg)
             
-            return inst
-        except self.model.MultipleObjectsReturned:
+            changed += [ f.name for f in self.model._meta.local_fields 
+                         if getattr(f, 'auto_now', False) and f.name not in changed ]
+        
+        try:
+            with transaction.atomic():
+                if changed:
+                    inst.save(update_fields=changed)
+                
+                for name, objs in m2m.items():
+                    manager = getattr(inst, name)
+                    manager.clear()
+                    manager.add(*objs)
+        except IntegrityError:
             return rc.DUPLICATE_ENTRY
         
-    
+        return inst
     
 class DefaultAnonymousHandler(DefaultHandler):
     is_anonymous = True
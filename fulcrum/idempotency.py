@@ -0,0 +1,165 @@
+"""
+Idempotency keys for POST requests.
+"""
+
+import hashlib, tempfile, time
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.encoding import smart_str
+
+from fulcrum.utils import rc, HttpStatusCode, Mimer
+
+class IdempotencyCache(object):
+    """
+    Stores the response to a POST carrying an `Idempotency-Key`
+    header, and replays it byte for byte when a retry comes in
+    with the same key. Keys are scoped to the resource, path and
+    user. Server errors (5xx) are not stored, so they can be retried.
+    
+    The response is stored with a fingerprint of the request's
+    content type and body. A key reused with a different payload
+    gets a 422 rather than another request's response.
+    
+    A retry arriving while the first request is still running
+    waits for it, for up to `wait` seconds, instead of running
+    the request a second time. After that it gets a 409.
+    
+    Parameters::
+     - `timeout`: How long responses are kept (default: 1 day)
+     - `lock_timeout`: How long a request may hold its key while running.
+     - `wait`: How long a concurrent retry waits for the first request.
+    """
+    header = 'HTTP_IDEMPOTENCY_KEY'
+    poll_interval = 0.05
+    
+    # Request bodies are hashed this much at a time, and
+    # spooled to disk beyond `spool_size` bytes.
+    chunk_size = 64 * 1024
+    spool_size = 1024 * 1024
+    
+    def __init__(self, timeout=60*60*24, lock_timeout=60, wait=10):
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.wait = wait
+        
+    def applies(self, request):
+        return request.method.upper() == 'POST' and bool(request.META.get(self.header))
+        
+    def get_key(self, request, scope):
+        user = getattr(request, 'user', None)
+        
+        if user is not None and user.is_authenticated():
+            ident = user.pk
+        else:
+            ident = ''
+        
+        raw = '%s:%s:%s:%s' % (scope, ident, request.path, request.META[self.header])
+        return 'fulcrum:idempotency:%s' % hashlib.sha1(smart_str(raw)).hexdigest()
+    
+    def fingerprint(self, request):
+        """
+        Hashes what the request submits. Batch sub-requests carry their
+        decoded body in `idempotency_body`; the batch's own is shared.
+        
+        Other bodies are read through `Mimer.body`, so the size limit
+        holds before anything is hashed, and a chunk at a time into a
+        temporary file that then stands in for the request body. That
+        keeps `stream_input` handlers reading it as a stream.
+        """
+        digest = hashlib.sha1(smart_str(request.META.get('CONTENT_TYPE', '')))
+        digest.update('\n')
+        
+        body = getattr(request, 'idempotency_body', None)
+        if body is not None:
+            digest.update(smart_str(body))
+            return digest.hexdigest()
+        
+        stream = Mimer(request).body()
+        spool = tempfile.SpooledTemporaryFile(self.spool_size)
+        
+        for chunk in iter(lambda: stream.read(self.chunk_size), ''):
+            digest.update(chunk)
+            spool.write(chunk)
+        
+        spool.seek(0)
+        request._stream = spool
+        request._read_started = False
+        
+        return digest.hexdigest()
+    
+    def replay(self, stored, fingerprint):
+        if stored.get('fingerprint') != fingerprint:
+            resp = rc.UNPROCESSABLE_ENTITY
+            resp.content = 'This Idempotency-Key was used with a different request body.'
+            return resp
+        return self.thaw(stored, replayed=True)
+    
+    def call(self, request, scope, func):
+        """
+        Returns the stored response for this request's key, or
+        runs `func` to produce (and store) it.
+        """
+        key = self.get_key(request, scope)
+        
+        try:
+            fingerprint = self.fingerprint(request)
+        except HttpStatusCode, e:
+            return e.response
+        
+        lock = key + ':lock'
+        deadline = time.time() + self.wait
+        
+        while True:
+            stored = cache.get(key)
+            if stored is not None:
+                return self.replay(stored, fingerprint)
+            
+            if cache.add(lock, 1, self.lock_timeout):
+                break
+            
+            if time.time() > deadline:
+                resp = rc.DUPLICATE_ENTRY
+                resp.content = 'A request with this Idempotency-Key is still in progress.'
+                return resp
+            
+            time.sleep(self.poll_interval)
+        
+        try:
+            # It may have finished between our `get` and `add`.
+            stored = cache.get(key)
+            if stored is not None:
+                return self.replay(stored, fingerprint)
+            
+            stored = self.freeze(func())
+            stored['fingerprint'] = fingerprint
+            
+            if stored['status'] < 500:
+                cache.set(key, stored, self.timeout)
+        finally:
+            cache.delete(lock)
+        
+        return self.thaw(stored)
+    
+    @staticmethod
+    def freeze(response):
+        if getattr(response, 'streaming', False) and hasattr(response, 'streaming_content'):
+            content = ''.join(response.streaming_content)
+        else:
+            content = response.content
+        
+        return { 'status': response.status_code,
+                 'headers': response.items(),
+                 'content': content }
+    
+    @staticmethod
+    def thaw(stored, replayed=False):
+        response = HttpResponse(stored['content'], status=stored['status'])
+        
+        for k, v in stored['headers']:
+            response[k] = v
+        
+        if replayed:
+            response['Idempotent-Replayed'] = 'true'
+        
+        return response
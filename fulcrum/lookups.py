@@ -0,0 +1,106 @@
+"""
+Query string filters.
+
+List requests take filters from the query string, such as
+`?author=3&created__gte=2016-01-01`. Each one is resolved against the
+model and its value coerced through the model field before it gets
+near a queryset, so a bad value is a 400 rather than a database error,
+and a handler's `filter_fields` decides which lookups are allowed at
+all (see `BaseHandler.clean_filters`).
+
+`manage.py filter_report` lists the filters of every resource, and
+flags those no index can serve.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db.models import FieldDoesNotExist
+
+from fulcrum import schemas
+
+LOOKUPS = ('exact', 'iexact', 'lt', 'lte', 'gt', 'gte', 'in', 'range', 'isnull',
+           'contains', 'icontains', 'startswith', 'istartswith', 'endswith', 'iendswith')
+
+# Lookups that match text as it's stored, so take the value as is.
+TEXT_LOOKUPS = ('iexact', 'contains', 'icontains', 'startswith', 'istartswith', 'endswith', 'iendswith')
+
+# Lookups a plain index on the field can serve. Not `startswith`:
+# that depends on the collation (or a pattern_ops index on Postgres).
+INDEXED_LOOKUPS = ('exact', 'lt', 'lte', 'gt', 'gte', 'in', 'range', 'isnull')
+
+def split(key):
+    """
+    Splits a filter into its field path and lookup, which
+    is 'exact' if none is given: 'author__name__in' gives
+    `(['author', 'name'], 'in')`.
+    """
+    parts = key.split('__')
+    if len(parts) > 1 and parts[-1] in LOOKUPS:
+        return parts[:-1], parts[-1]
+    return parts, 'exact'
+
+def normalize(key):
+    """
+    Spells out the lookup of a filter, so 'author' and
+    'author__exact' compare equal.
+    """
+    path, lookup = split(key)
+    return '__'.join(path + [lookup])
+
+def resolve(model, key):
+    """
+    Returns the field a filter on `model` ends at, and its lookup.
+    Raises ValueError if there's no such field, or the path runs
+    through anything but the model's own relations.
+    """
+    path, lookup = split(key)
+    opts = model._meta
+    
+    for i, name in enumerate(path):
+        try:
+            field = name == 'pk' and opts.pk or opts.get_field(name)
+        except FieldDoesNotExist:
+            raise ValueError('Unknown field %s.' % '__'.join(path[:i + 1]))
+        
+        if field.auto_created and not field.concrete:
+            raise ValueError('Can not filter on the reverse relation %s.' % '__'.join(path[:i + 1]))
+        
+        if i < len(path) - 1:
+            if field.rel is None:
+                raise ValueError('%s is not a relation.' % '__'.join(path[:i + 1]))
+            opts = field.rel.to._meta
+    
+    return field, lookup
+
+def coerce(field, lookup, value):
+    """
+    Converts a query string value for `lookup` on `field` into what
+    the queryset expects. `in` and `range` take comma separated lists,
+    `isnull` a boolean. Raises ValidationError on bad values.
+    """
+    if not isinstance(value, basestring):
+        return value
+    
+    if lookup == 'isnull':
+        return value.lower() not in ('0', 'false', '')
+    
+    if lookup in TEXT_LOOKUPS:
+        return value
+    
+    if field.rel is not None:
+        to_python = field.rel.get_related_field().to_python
+    else:
+        to_python = field.to_python
+    
+    if lookup in ('in', 'range'):
+        values = [ to_python(v) for v in value.split(',') ]
+        if lookup == 'range' and len(values) != 2:
+            raise ValidationError('A range takes two values.')
+        return values
+    
+    return to_python(value)
+
+def is_indexed(field, lookup):
+    """
+    Whether an index can serve `lookup` on `field`.
+    """
+    return lookup in INDEXED_LOOKUPS and field.name in schemas.indexed_fields(field.model)
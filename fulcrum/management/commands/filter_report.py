@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+
+from fulcrum import lookups, schemas
+from fulcrum.sites import site
+
+class Command(BaseCommand):
+    help = 'Lists the filters each resource takes, and flags those no index can serve.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--unindexed', action='store_true', default=False, dest='unindexed',
+            help='Only list filters with no supporting index.')
+    
+    def handle(self, *args, **options):
+        flagged = 0
+        
+        for name in sorted(site.registry):
+            resource = site.registry[name]
+            handler = resource.handler
+            if resource.arbitrary or not hasattr(handler, 'clean_filters'):
+                continue
+            
+            if handler.filter_fields is None:
+                keys = sorted(schemas.indexed_fields(resource.model))
+            else:
+                keys = list(handler.filter_fields)
+            for key in tuple(handler.bulk_delete_filters) + tuple(getattr(handler, 'bulk_update_filters', ())):
+                if key not in keys:
+                    keys.append(key)
+            
+            lines = []
+            for key in keys:
+                try:
+                    field, lookup = lookups.resolve(resource.model, key)
+                except ValueError, e:
+                    lines.append('  %-40s INVALID: %s' % (key, e))
+                    flagged += 1
+                    continue
+                
+                if lookups.is_indexed(field, lookup):
+                    if not options['unindexed']:
+                        lines.append('  %-40s indexed' % key)
+                else:
+                    lines.append('  %-40s NO INDEX on %s.%s' % (key, field.model._meta.db_table, field.column or field.name))
+                    flagged += 1
+            
+            if lines:
+                opts = resource.model._meta
+                self.stdout.write('%s (%s.%s)' % (name, opts.app_label, opts.object_name))
+                self.stdout.write('\n'.join(lines))
+        
+        self.stdout.write('%d filters flagged.' % flagged)
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from fulcrum.models import Change
+
+class Command(BaseCommand):
+    help = 'Deletes changes feed entries older than clients are expected to sync.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size',
+            help='Number of rows to delete per statement.')
+        parser.add_argument('--threshold', type=int,
+            default=getattr(settings, 'FULCRUM_CHANGES_TIMEOUT', 60*60*24*30),
+            dest='threshold', help='Age in seconds after which an entry expires.')
+    
+    def handle(self, *args, **options):
+        deleted = Change.objects.prune(options['threshold'], options['batch_size'])
+        self.stdout.write('Deleted %d expired changes.' % deleted)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from fulcrum import oauth
+from fulcrum.models import Nonce
+
+class Command(BaseCommand):
+    help = 'Deletes OAuth nonces that are too old to be replayed.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size',
+            help='Number of rows to delete per statement.')
+        parser.add_argument('--threshold', type=int, default=oauth.OAuthServer.timestamp_threshold,
+            dest='threshold', help='Age in seconds after which a nonce expires.')
+    
+    def handle(self, *args, **options):
+        deleted = Nonce.objects.prune(options['threshold'], options['batch_size'])
+        self.stdout.write('Deleted %d expired nonces.' % deleted)
@@ -1,4 +1,7 @@
+import datetime, time
+
 from django.db import models
+from django.utils import timezone
 #from django.contrib.auth.models import User
 
 KEY_SIZE = 16
@@ -24,6 +27,108 @@ class ConsumerManager(models.Manager):
     
     _default_consumer = None
 
+class NonceManager(models.Manager):
+    def prune(self, threshold, batch_size=1000):
+        """
+        Deletes nonces whose timestamp is more than `threshold`
+        seconds old, `batch_size` rows at a time so no single
+        statement holds locks for long. Returns the number of
+        rows deleted.
+        """
+        cutoff = int(time.time()) - threshold
+        deleted = 0
+        
+        while True:
+            pks = list(self.filter(timestamp__lt=cutoff)
+                           .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            
+            self.filter(pk__in=pks).delete()
+            deleted += len(pks)
+        
+        return deleted
+
+class ChangeManager(models.Manager):
+    # The label of the marker entry holding the highest pruned id.
+    PRUNED = 'fulcrum.pruned'
+    
+    def pruned(self):
+        """
+        Returns the highest id `prune` has deleted, or 0.
+        """
+        marker = list(self.filter(model=self.PRUNED).values_list('object_pk', flat=True)[:1])
+        return marker and int(marker[0]) or 0
+    
+    def feed(self, label, since, limit, settle=0):
+        """
+        Returns the distinct primary keys of `label` objects changed after
+        the token `since`, scanning at most `limit` entries, and the token
+        to continue from, as `(pks, token, more)`.
+        
+        Entries logged in the last `settle` seconds are held back: ids are
+        handed out on insert but show up on commit, so a newer entry can
+        be visible before an older one is. Writes taking longer than
+        `settle` to commit can still be missed.
+        
+        Returns None if entries after `since` have been pruned: the
+        client has to start over.
+        """
+        if since and since < self.pruned():
+            return None
+        
+        settled = self.filter(pk__gt=since)
+        if settle:
+            settled = settled.filter(created__lt=timezone.now() - datetime.timedelta(seconds=settle))
+        
+        entries = list(settled.filter(model=label)
+                              .order_by('pk').values_list('pk', 'object_pk')[:limit])
+        
+        pks = []
+        seen = set()
+        for id, pk in entries:
+            if pk not in seen:
+                seen.add(pk)
+                pks.append(pk)
+        
+        if entries:
+            token = entries[-1][0]
+        else:
+            # Nothing new for this model: skip ahead to the latest
+            # settled entry of any model, so the next scan starts there.
+            token = settled.aggregate(latest=models.Max('pk'))['latest'] or since
+        
+        return pks, token, len(entries) == limit
+        
+    def prune(self, threshold, batch_size=1000):
+        """
+        Deletes entries more than `threshold` seconds old, `batch_size`
+        rows at a time, and records the highest id deleted. Clients
+        holding an older token get told to start over. Returns the
+        number of rows deleted.
+        """
+        cutoff = timezone.now() - datetime.timedelta(seconds=threshold)
+        deleted = 0
+        highest = 0
+        
+        while True:
+            pks = list(self.filter(created__lt=cutoff).exclude(model=self.PRUNED)
+                           .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            
+            # Record the mark before the rows go, so no reader
+            # ever sees them gone without it.
+            highest = max(highest, max(pks))
+            if highest > self.pruned():
+                if not self.filter(model=self.PRUNED).update(object_pk=str(highest)):
+                    self.create(model=self.PRUNED, object_pk=str(highest))
+            
+            self.filter(pk__in=pks).delete()
+            deleted += len(pks)
+        
+        return deleted
+
 class ResourceManager(models.Manager):
     _default_resource = None
 
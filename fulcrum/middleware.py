@@ -5,13 +5,15 @@ def compat_middleware_factory(klass):
     """
     Class wrapper that only executes `process_response`
     if `streaming` is not set on the `HttpResponse` object.
+    Conditional resources answer `If-None-Match` themselves,
+    streaming or not (see `Resource.get_validators`).
     Django has a bad habbit of looking at the content,
     which will prematurely exhaust the data source if we're
     using generators or buffers.
     """
     class compatwrapper(klass):
         def process_response(self, req, resp):
-            if not hasattr(resp, 'streaming'):
+            if not getattr(resp, 'streaming', False):
                 return klass.process_response(self, req, resp)
             return resp
     return compatwrapper
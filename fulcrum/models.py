@@ -1,5 +1,7 @@
 import urllib
 from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
 from django.conf import settings
 #from django.contrib.auth.models import User
 from django.contrib import admin
@@ -7,12 +9,24 @@ from django.conf import settings
 from django.core.mail import send_mail, mail_admins
 from django.template import loader
 
-from managers import TokenManager, ConsumerManager, ResourceManager
+from managers import TokenManager, ConsumerManager, ResourceManager, NonceManager, ChangeManager
+from caching import TieredCache
 import log
 
 KEY_SIZE = 18
 SECRET_SIZE = 32
 
+# Lookup caches for `fulcrum.store.DataStore`. Saving or deleting
+# a consumer or token invalidates its entry, under both its current
+# and its previous key, as does saving or deleting the consumer or
+# user a token belongs to. `QuerySet.update()` sends no signals, so
+# entries it changes live out the timeouts; call `evict_tokens`.
+OAUTH_CACHE_TIMEOUT = getattr(settings, 'FULCRUM_OAUTH_CACHE_TIMEOUT', 300)
+OAUTH_LOCAL_CACHE_TIMEOUT = getattr(settings, 'FULCRUM_OAUTH_LOCAL_CACHE_TIMEOUT', 30)
+
+consumer_cache = TieredCache('oauth:consumer', OAUTH_CACHE_TIMEOUT, OAUTH_LOCAL_CACHE_TIMEOUT)
+token_cache = TieredCache('oauth:token', OAUTH_CACHE_TIMEOUT, OAUTH_LOCAL_CACHE_TIMEOUT)
+
 CONSUMER_STATES = (
     ('pending', 'Pending approval'),
     ('accepted', 'Accepted'),
@@ -21,17 +35,43 @@ CONSUMER_STATES = (
 
 class Nonce(models.Model):
     """
-    Number used once
+    Number used once. Only needs to be kept for as long as
+    the request timestamp it came with is still accepted;
+    see `NonceManager.prune`.
     """
     token_key = models.CharField(max_length=KEY_SIZE)
     consumer_key = models.CharField(max_length=KEY_SIZE)
     key = models.CharField(max_length=255)
+    timestamp = models.IntegerField(default=0, db_index=True)
+    
+    objects = NonceManager()
+    
+    class Meta:
+        unique_together = (('consumer_key', 'token_key', 'key'),)
     
     def __unicode__(self):
         return u"Nonce %s for %s" % (self.key, self.consumer_key)
 
 admin.site.register(Nonce)
 
+class Change(models.Model):
+    """
+    Changes feed entry: the object with primary key `object_pk` of
+    `model` (an 'app_label.model_name' label) was saved or deleted.
+    The entry's id is the sync token. See `fulcrum.changes`.
+    """
+    model = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    objects = ChangeManager()
+    
+    class Meta:
+        index_together = (('model', 'id'),)
+    
+    def __unicode__(self):
+        return u"Change %d of %s %s" % (self.pk, self.model, self.object_pk)
+
 class Resource(models.Model):
     name = models.CharField(max_length=255)
     url = models.TextField(max_length=2047)
@@ -48,7 +88,7 @@ class Consumer(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
 
-    key = models.CharField(max_length=KEY_SIZE)
+    key = models.CharField(max_length=KEY_SIZE, db_index=True)
     secret = models.CharField(max_length=SECRET_SIZE)
 
     status = models.CharField(max_length=16, choices=CONSUMER_STATES, default='pending')
@@ -115,7 +155,7 @@ class Token(models.Model):
     ACCESS = 2
     TOKEN_TYPES = ((REQUEST, u'Request'), (ACCESS, u'Access'))
     
-    key = models.CharField(max_length=KEY_SIZE)
+    key = models.CharField(max_length=KEY_SIZE, db_index=True)
     secret = models.CharField(max_length=SECRET_SIZE)
     token_type = models.IntegerField(choices=TOKEN_TYPES)
     timestamp = models.IntegerField()
@@ -137,7 +177,11 @@ class Token(models.Model):
         if only_key:
             del token_dict['oauth_token_secret']
         return urllib.urlencode(token_dict)
-
+    
+    @staticmethod
+    def cache_key(key, token_type):
+        return '%s:%s' % (token_type, key)
+    
     def generate_random_codes(self):
         key = settings.AUTH_USER_MODEL.objects.make_random_password(length=KEY_SIZE)
         secret = settings.AUTH_USER_MODEL.objects.make_random_password(length=SECRET_SIZE)
@@ -149,4 +193,51 @@ class Token(models.Model):
         self.secret = secret
         self.save()
         
-admin.site.register(Token)
\ No newline at end of file
+admin.site.register(Token)
+
+def evict_tokens(**filters):
+    """
+    Drops the cached tokens matching `filters`, such as `consumer=c`.
+    """
+    for key, token_type in Token.objects.filter(**filters).values_list('key', 'token_type'):
+        token_cache.delete(Token.cache_key(key, token_type))
+
+@receiver(post_init, sender=Consumer)
+@receiver(post_init, sender=Token)
+def remember_key(sender, instance, **kwargs):
+    # The key as loaded, to invalidate once `generate_random_codes` rotates it.
+    # Deferred fields would cost a query each, so are left alone.
+    instance._loaded_key = instance.__dict__.get('key')
+
+@receiver(post_save, sender=Consumer)
+@receiver(post_delete, sender=Consumer)
+def consumer_changed(sender, instance, **kwargs):
+    for key in set([instance.key, getattr(instance, '_loaded_key', None)]) - set([None]):
+        consumer_cache.delete(key)
+    instance._loaded_key = instance.key
+    
+    # Cached tokens carry their consumer along.
+    if instance.pk is not None:
+        evict_tokens(consumer=instance)
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    for key in set([instance.key, getattr(instance, '_loaded_key', None)]) - set([None]):
+        token_cache.delete(Token.cache_key(key, instance.token_type))
+    instance._loaded_key = instance.key
+
+def user_changed(sender, instance, **kwargs):
+    """
+    Drops the cached tokens and consumers of a user that's saved
+    or deleted, so deactivating them takes effect right away.
+    Connected to the user model in `FulcrumConfig.ready`.
+    """
+    # Logging in saves just `last_login`, which nothing cached depends on.
+    if set(kwargs.get('update_fields') or ()) == set(['last_login']):
+        return
+    
+    if instance.pk is not None:
+        evict_tokens(user=instance)
+        for key in Consumer.objects.filter(user=instance).values_list('key', flat=True):
+            consumer_cache.delete(key)
@@ -0,0 +1,145 @@
+"""
+Parallel serialization of large querysets.
+
+`Emitter.construct` is pure Python, so one request can only ever
+serialize on one core. Resources registered with `parallel=<rows>`
+split big queryset results into primary key ranges of about that
+many rows, serialize the ranges on a process pool, and stream the
+encoded chunks back in order. Rows come out in primary key order.
+
+Only emitters with `render_chunk` and `stitch` (JSON and XML) can
+be split, and only querysets with an integer primary key that are
+unordered or ordered by it, so results come out the same at any size.
+
+The pool, of `FULCRUM_PARALLEL_WORKERS` processes, is forked by the
+first request that needs it, in each server process: a pool forked
+before a preforking server forks its workers is no use to them. Without
+the setting, everything renders serially.
+"""
+
+import math, multiprocessing, os, pickle, threading
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Min, Max
+
+from fulcrum.handler import typemapper
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+def get_pool():
+    """
+    Returns this process' pool, forking it on first use, or None if
+    `FULCRUM_PARALLEL_WORKERS` isn't set. A pool inherited through a
+    fork belongs to the parent, so a process whose pid differs from
+    the one that made the pool gets a new one.
+    
+    Database connections are closed first, so the workers don't share
+    the parent's sockets: each opens its own on its first query.
+    """
+    global _pool, _pool_pid
+    
+    workers = getattr(settings, 'FULCRUM_PARALLEL_WORKERS', None)
+    if not workers:
+        return None
+    
+    pid = os.getpid()
+    
+    with _lock:
+        if _pool is None or _pool_pid != pid:
+            for connection in connections.all():
+                connection.close()
+            _pool, _pool_pid = multiprocessing.Pool(workers), pid
+    
+    return _pool
+
+def pk_ordered(queryset):
+    """
+    Whether `queryset` comes out unordered, or in primary key order.
+    """
+    query = queryset.query
+    if query.extra_order_by:
+        return False
+    
+    if query.order_by:
+        ordering = query.order_by
+    elif query.default_ordering:
+        ordering = queryset.model._meta.ordering
+    else:
+        ordering = ()
+    
+    pk = queryset.model._meta.pk
+    return all([ o in ('pk', pk.name, pk.attname) for o in ordering ])
+
+def render_chunk(task):
+    """
+    Runs on a worker: serializes one primary key range.
+    """
+    model, query, low, high, emitter, handler, fields, anonymous, recurse_level = task
+    
+    queryset = model._default_manager.all()
+    queryset.query = query
+    
+    rows = list(queryset.filter(pk__gte=low, pk__lt=high).order_by('pk'))
+    
+    return emitter(rows, recurse_level, typemapper, handler, fields, anonymous).render_chunk()
+
+def split(queryset, chunk_size):
+    """
+    Returns the `(low, high)` primary key ranges to serialize
+    `queryset` in, or None if it isn't worth splitting. Costs
+    a count and a min/max aggregate.
+    """
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    low, high = bounds['low'], bounds['high']
+    
+    if not isinstance(low, (int, long)) or not isinstance(high, (int, long)):
+        return None
+    
+    chunks = int(math.ceil(queryset.count() / float(chunk_size)))
+    if chunks < 2:
+        return None
+    
+    # Assumes keys are spread evenly; gaps just make for smaller chunks.
+    step = max((high - low + 1) // chunks, 1)
+    
+    return [ (start, min(start + step, high + 1)) for start in xrange(low, high + 1, step) ]
+
+def stream_render(queryset, emitter, request, handler, anonymous, recurse_level, chunk_size):
+    """
+    Returns a generator of `queryset` rendered by `emitter` on the
+    process pool, or None if it can't or needn't be split, leaving
+    the caller to render as usual.
+    """
+    if not hasattr(emitter, 'render_chunk') or get_pool() is None:
+        return None
+    
+    # Chunks come back in primary key order.
+    if not pk_ordered(queryset):
+        return None
+    
+    # Workers can't see rows of a transaction that isn't committed.
+    if connections[queryset.db].in_atomic_block:
+        return None
+    
+    # Sliced querysets can't be filtered any further.
+    if queryset.query.low_mark or queryset.query.high_mark is not None:
+        return None
+    
+    ranges = split(queryset, chunk_size)
+    if ranges is None:
+        return None
+    
+    tasks = [ (queryset.model, queryset.query, low, high, emitter,
+               handler, handler.fields, anonymous, recurse_level) for low, high in ranges ]
+    
+    # Find out now if a handler can't be sent to the workers,
+    # rather than once the response is half way out.
+    try:
+        pickle.dumps(tasks[0], pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+    
+    return emitter.stitch(get_pool().imap(render_chunk, tasks), request)
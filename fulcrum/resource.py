@@ -1,9 +1,11 @@
-import sys, inspect
+import sys, inspect, hashlib, calendar
 
 from django.http import (HttpResponse, Http404, HttpResponseNotAllowed,
-    HttpResponseForbidden, HttpResponseServerError)
+    HttpResponseForbidden, HttpResponseServerError, HttpResponseNotModified,
+    StreamingHttpResponse)
 from django.views.debug import ExceptionReporter
-from django.views.decorators.vary import vary_on_headers
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
 from django.conf import settings
 from django.core.mail import send_mail, EmailMessage
 
@@ -12,7 +14,8 @@ from handler import typemapper
 from doc import HandlerMethod
 from authentication import NoAuthentication
 from utils import coerce_put_post, FormValidationError, HttpStatusCode
-from utils import rc, format_error, translate_mime, MimerDataException
+from utils import rc, format_error, translate_mime, MimerDataException, throttled, etag_matches
+from utils import accepts_gzip, gzip_stream, gzip_etag, file_response
 
 from django.db import models
 from django.db.models.query import QuerySet
@@ -29,6 +32,11 @@ from django.template import Context, RequestContext
 #from django.contrib.sites.models import Site
 
 from datastructures import EasyModel
+from idempotency import IdempotencyCache
+import parallel
+from changes import track
+from caching import NeverCache, BodySpool, get_model_version, bump_model_version, track_changes, related_models
+from caching import check_version_cache
 import schemas
 import log
 
@@ -41,9 +49,9 @@ class Resource(object):
     `NoAuthentication` will be used by default.
     """
     callmap = { 'GET': 'read', 'POST': 'create', 
-                'PUT': 'update', 'DELETE': 'delete' }
+                'PUT': 'update', 'PATCH': 'update', 'DELETE': 'delete' }
     
-    def __init__(self, handler, site, name=None, authentication=None, group=None):
+    def __init__(self, handler, site, name=None, authentication=None, group=None, **options):
         #if not callable(handler):
         #    raise AttributeError, "Handler not callable."
         
@@ -64,27 +72,107 @@ class Resource(object):
         
         self.authentication = authentication
         self.arbitrary = False
+        self.configure(**options)
+    
+    def configure(self, throttle=None, idempotency=None, cache_policy=None, conditional=False,
+                  gzip_min_length=None, exports=False, spool=False, parallel=None, changes=False,
+                  **options):
+        """
+        Applies the per-resource options passed to
+        `FulcrumSite.register`.
+        
+        Parameters::
+         - `throttle`: A `fulcrum.throttling.Throttle` checked
+           on every request, after authentication.
+         - `idempotency`: The `IdempotencyCache` that honours
+           `Idempotency-Key` on POST. By default one keeping
+           responses for `FULCRUM_IDEMPOTENCY_TIMEOUT` seconds
+           (1 day); pass False to turn it off.
+         - `cache_policy`: A `fulcrum.caching.CachePolicy` for the
+           `Cache-Control` of responses. Without one, responses
+           are never cached.
+         - `conditional`: Answer GETs with an `ETag` (and with the
+           handler's `last_modified_field`, `Last-Modified`), and
+           `If-None-Match`/`If-Modified-Since` with a 304 before
+           the handler runs. See `get_validators`. Versions are
+           kept in the default cache, which must be shared by all
+           processes, like memcached or Redis.
+         - `gzip_min_length`: The size from which response bodies are
+           gzipped for clients that accept it. By default
+           `FULCRUM_GZIP_MIN_LENGTH` bytes (1024); pass False to
+           turn gzip off.
+         - `exports`: Offer background exports of the resource,
+           see `fulcrum.exports`.
+         - `spool`: Keep large bodies on disk and serve repeats from
+           there, see `fulcrum.caching.BodySpool`. True for the
+           default spool. Needs `conditional`, for the ETags.
+         - `parallel`: Serialize querysets of more than this many
+           rows on a process pool, this many at a time, see
+           `fulcrum.parallel`. Off by default, and needs the
+           pool of `FULCRUM_PARALLEL_WORKERS` processes.
+         - `changes`: Log every change to the model, and offer
+           the feed of them at `<resource>/changes.<format>`, see
+           `fulcrum.changes`.
+        """
         # Erroring
         self.email_errors = getattr(settings, 'FULCRUM_EMAIL_ERRORS', True)
         self.display_errors = getattr(settings, 'FULCRUM_DISPLAY_ERRORS', True)
         self.stream = getattr(settings, 'FULCRUM_STREAM_OUTPUT', False)
+        
+        self.throttle = throttle or None
+        
+        if idempotency is None:
+            idempotency = IdempotencyCache(getattr(settings, 'FULCRUM_IDEMPOTENCY_TIMEOUT', 60*60*24))
+        self.idempotency = idempotency
+        
+        self.cache_policy = cache_policy or NeverCache()
+        
+        if gzip_min_length is None:
+            gzip_min_length = getattr(settings, 'FULCRUM_GZIP_MIN_LENGTH', 1024)
+        if gzip_min_length is False:
+            gzip_min_length = None
+        self.gzip_min_length = gzip_min_length
+        
+        self.exports = exports and getattr(self, 'model', None) is not None
+        
+        self.conditional = conditional and getattr(self, 'model', None) is not None
+        self.related_models = [ ]
+        if self.conditional:
+            check_version_cache()
+            self.related_models = related_models(self.model, getattr(self.handler, 'fields', ()))
+            for model in [ self.model ] + self.related_models:
+                track_changes(model)
+        
+        self.parallel = parallel
+        
+        self.changes = changes and getattr(self, 'model', None) is not None
+        if self.changes:
+            track(self.model)
+        
+        if spool is True:
+            spool = BodySpool()
+        self.spool = self.conditional and spool or None
 
     def determine_emitter(self, request, *args, **kwargs):
         """
         Function for determening which emitter to use
         for output. It lives here so you can easily subclass
         `Resource` in order to change how emission is detected.
-
-        You could also check for the `Accept` HTTP header here,
-        since that pretty much makes sense. Refer to `Mimer` for
-        that as well.
+        
+        In order of precedence: the format in the URL (the
+        `emitter_format` keyword), `?format=`, the `Accept`
+        header, and finally the `default_format` keyword,
+        which defaults to JSON.
         """
         em = kwargs.pop('emitter_format', None)
         
         if not em:
-            em = request.GET.get('format', 'json')
-
-        return em
+            em = request.GET.get('format')
+        
+        if not em and request.META.get('HTTP_ACCEPT'):
+            em = Emitter.negotiate(request.META['HTTP_ACCEPT'])
+        
+        return em or kwargs.pop('default_format', None) or 'json'
     
     def get_recurse_level(self, request):
         recurse = int(request.GET.get('recurse', 0))
@@ -92,44 +180,105 @@ class Resource(object):
             return recurse
         return 0
     
-    @vary_on_headers('Authorization')
-    def handle(self, request,*args, **kwargs):
+    def is_authenticated(self, request):
         """
-        NB: Sends a `Vary` header so we don't cache requests
-        that are different (OAuth stuff in `Authorization` header.)
+        Runs this resource's authentication. Sub-requests made
+        by `FulcrumSite.batch` share a memo in `fulcrum_auth`,
+        so each authentication runs at most once per batch.
         """
+        memo = getattr(request, 'fulcrum_auth', None)
         
+        if memo is None:
+            return self.authentication.is_authenticated(request)
+        
+        key = id(self.authentication)
+        
+        if key not in memo:
+            memo[key] = (self.authentication.is_authenticated(request),
+                         getattr(request, 'user', None))
+        
+        authenticated, request.user = memo[key]
+        return authenticated
+    
+    def handle(self, request, *args, **kwargs):
+        """
+        Serves a request, and applies the resource's `cache_policy`
+        to the response. Responses vary on `Accept`, as the format may
+        be negotiated, and unless the policy is public on `Authorization`
+        (OAuth stuff in there), so caches don't mix them up.
+        """
+        response = self.respond(request, *args, **kwargs)
+        patch_vary_headers(response, self.gzip_min_length is None and ('Accept',) 
+                                     or ('Accept', 'Accept-Encoding'))
+        return self.cache_policy.apply(request, response)
+    
+    def get_handler(self, request, method):
+        """
+        Authenticates `request`, and returns the `(handler, anonymous)`
+        pair to serve it with, or None if it has to be challenged.
+        """
+        if self.is_authenticated(request):
+            return self.handler, self.handler.is_anonymous
+        
+        if hasattr(self.handler, 'anonymous') and \
+            callable(self.handler.anonymous) and \
+            method in self.handler.anonymous.allowed_methods:
+            
+            return self.handler.anonymous(), True
+        
+        return None
+    
+    def respond(self, request, *args, **kwargs):
+        """
+        Authenticates, throttles and dispatches a request.
+        """
         rm = request.method.upper()
 
         # Django's internal mechanism doesn't pick up
-        # PUT request, so we trick it a little here.
-        if rm == "PUT":
+        # PUT (or PATCH) request, so we trick it a little here.
+        if rm in ("PUT", "PATCH"):
             coerce_put_post(request)
 
-        if not self.authentication.is_authenticated(request):
-            if hasattr(self.handler, 'anonymous') and \
-                callable(self.handler.anonymous) and \
-                rm in self.handler.anonymous.allowed_methods:
-
-                handler = self.handler.anonymous()
-                anonymous = True
-            else:
-                return self.authentication.challenge()
-        else:
-            handler = self.handler
-            anonymous = handler.is_anonymous
+        served = self.get_handler(request, rm)
+        if served is None:
+            return self.authentication.challenge()
+        handler, anonymous = served
         
-        # Translate nested datastructs into `request.data` here.
-        if rm in ('POST', 'PUT'):
+        if self.throttle is not None:
+            wait = self.throttle.check(request, self.name)
+            if wait is not None:
+                return throttled(wait)
+        
+        if self.idempotency and self.idempotency.applies(request):
+            return self.idempotency.call(request, self.name,
+                lambda: self.dispatch(request, handler, anonymous, *args, **kwargs))
+        
+        return self.dispatch(request, handler, anonymous, *args, **kwargs)
+    
+    def dispatch(self, request, handler, anonymous, *args, **kwargs):
+        """
+        Calls the handler method for an authenticated request
+        and serializes the result.
+        """
+        rm = request.method.upper()
+        
+        # Translate nested datastructs into `request.data` here, or into
+        # `request.data_stream` for handlers that consume POSTs as a stream.
+        if rm in ('POST', 'PUT', 'PATCH'):
             try:
-                translate_mime(request)
+                translate_mime(request, stream=rm == 'POST' and getattr(handler, 'stream_input', False))
             except MimerDataException:
                 return rc.BAD_REQUEST
+            except HttpStatusCode, e:
+                return e.response
         
         if not rm in handler.allowed_methods:
             return HttpResponseNotAllowed(handler.allowed_methods)
         
-        meth = getattr(handler, self.callmap.get(rm), None)
+        # Views for the extra endpoints, like the changes feed,
+        # name the handler method to call.
+        handler_method = kwargs.pop('handler_method', None)
+        meth = getattr(handler, handler_method or self.callmap.get(rm), None)
                 
         if not meth:
             raise Http404
@@ -137,6 +286,7 @@ class Resource(object):
         # Support emitter both through (?P<emitter_format>) and ?format=emitter.
         em_format = self.determine_emitter(request, *args, **kwargs)
         kwargs.pop('emitter_format', None)
+        kwargs.pop('default_format', None)
 
         # result is just html, handled in template
         # TODO: move this block into sites.py view handler
@@ -152,14 +302,36 @@ class Resource(object):
         # very well have `oauth_`-headers in there, and we
         # don't want to pass these along to the handler.
         request = self.cleanup_request(request)
+        
+        validators = None
+        if self.conditional and rm == 'GET':
+            validators = self.get_validators(request, handler, em_format, handler_method, *args, **kwargs)
+            if self.not_modified(request, *validators):
+                return self.set_validators(HttpResponseNotModified(), *validators)
+            if self.spool:
+                spooled = self.serve_spooled(request, em_format, *validators)
+                if spooled is not None:
+                    return spooled
                 
         try:
             # result is either a single object or a list of objects
             # something like... [<Blogpost: Sample test post 2>]
             result = meth(request, *args, **kwargs)
+            
+            # `?count=` and `?aggregate=` on a list.
+            if rm == 'GET' and isinstance(result, QuerySet) and hasattr(handler, 'summarize'):
+                result = handler.summarize(request, result)
+            
+            # Bump again once the handler's transaction is committed, or
+            # a read racing the commit could tag old data with a new ETag.
+            if self.conditional and rm != 'GET':
+                bump_model_version(self.model)
         except FormValidationError, e:
             # TODO: Use rc.BAD_REQUEST here
             return HttpResponse("Bad Request: %s" % e.form.errors, status=400)
+        except MimerDataException:
+            # A streamed body turned out to be malformed part way through.
+            return rc.BAD_REQUEST
         except TypeError, e:
                         
             result = rc.BAD_REQUEST
@@ -207,6 +379,11 @@ class Resource(object):
             else:
                 raise
         
+        # Handlers returning a response of their own get it sent as is,
+        # not half way into a streamed body.
+        if isinstance(result, HttpResponse):
+            return result
+        
         # Return serialized data
         emitter, ct = Emitter.get(em_format)
         srl = emitter(result, recurse_level, typemapper, handler, handler.fields, anonymous)
@@ -218,15 +395,134 @@ class Resource(object):
             before sending it to the client. Won't matter for
             smaller datasets, but larger will have an impact.
             """
-            if self.stream: stream = srl.stream_render(request)
-            else: stream = srl.render(request)
+            stream = None
+            if self.parallel and isinstance(result, QuerySet):
+                stream = parallel.stream_render(result, emitter, request, handler, anonymous,
+                                                recurse_level, self.parallel)
+            
+            streaming = stream is not None or self.stream
+            
+            if stream is None:
+                if self.stream: stream = srl.stream_render(request)
+                else: stream = srl.render(request)
+            
+            gzip = self.use_gzip(request, stream, streaming)
+            
+            if streaming:
+                resp = StreamingHttpResponse(gzip and gzip_stream(stream) or stream, content_type=ct)
+            else:
+                content = smart_str(stream)
+                resp = HttpResponse(gzip and ''.join(gzip_stream([content])) or content, content_type=ct)
+            
+            if validators:
+                etag, last_modified = validators
+                etag = gzip and gzip_etag(etag) or etag
+                
+                # Big bodies go to the spool, and out as a file from there.
+                path = self.spool and not streaming and self.spool.put(etag, resp.content)
+                if path:
+                    resp = file_response(request, path, ct)
+                
+                self.set_validators(resp, etag, last_modified)
+            
+            if gzip:
+                resp['Content-Encoding'] = 'gzip'
             
-            resp = HttpResponse(stream, mimetype=ct)
-            resp.streaming = self.stream
             return resp
         except HttpStatusCode, e:
             return e.response
 
+    def serve_spooled(self, request, em_format, etag, last_modified):
+        """
+        Serves the body an earlier request with the same ETag left in
+        the spool, or returns None if there isn't one.
+        """
+        gzip = self.gzip_min_length is not None and accepts_gzip(request)
+        if gzip:
+            etag = gzip_etag(etag)
+        
+        path = self.spool.get(etag)
+        if path is None:
+            return None
+        
+        emitter, ct = Emitter.get(em_format)
+        
+        try:
+            resp = self.set_validators(file_response(request, path, ct), etag, last_modified)
+        except (OSError, IOError):
+            # Pruned since `get` found it; render it again.
+            return None
+        
+        if gzip:
+            resp['Content-Encoding'] = 'gzip'
+        
+        return resp
+
+    def use_gzip(self, request, content, streaming):
+        """
+        Whether to gzip a response body: the client must accept it,
+        and buffered bodies be at least `gzip_min_length` bytes long.
+        Streamed bodies are assumed to be large, and always are.
+        """
+        if self.gzip_min_length is None or not accepts_gzip(request):
+            return False
+        
+        return streaming or len(content) >= self.gzip_min_length
+
+    def get_validators(self, request, handler, em_format, handler_method=None, *args, **kwargs):
+        """
+        Returns the `(etag, last_modified)` pair of a conditional GET,
+        without running the handler or rendering anything.
+        
+        The ETag hashes the data versions (see
+        `fulcrum.caching.get_model_version`) of the model and of the
+        `related_models` nested in its output with everything else the
+        response depends on: the path, query string and format, and
+        unless the cache policy is public, the user. Data computed by
+        handler methods is left out.
+        
+        `last_modified` is a timestamp from the handler's `last_modified`,
+        or None. It only vouches for the row itself, so is left out for
+        lists (deletions don't show in it), for models with related data,
+        and for handler methods other than `read`, like the changes feed.
+        """
+        shape = [ self.name, get_model_version(self.model),
+                  [ get_model_version(model) for model in self.related_models ],
+                  request.path, em_format, sorted(request.GET.items()) ]
+        
+        if not self.cache_policy.public:
+            shape.append(getattr(getattr(request, 'user', None), 'pk', None))
+        
+        etag = 'W/"%s"' % hashlib.md5(repr(shape)).hexdigest()
+        
+        last_modified = None
+        single = self.model._meta.pk.name in kwargs or 'pk' in kwargs
+        if handler_method is None and single and not self.related_models:
+            last_modified = getattr(handler, 'last_modified', lambda *a, **kw: None)(request, *args, **kwargs)
+        if last_modified is not None:
+            last_modified = calendar.timegm(getattr(last_modified, 'utctimetuple', last_modified.timetuple)())
+        
+        return etag, last_modified
+
+    @staticmethod
+    def not_modified(request, etag, last_modified):
+        """
+        Evaluates `If-None-Match`, or failing that `If-Modified-Since`.
+        """
+        if request.META.get('HTTP_IF_NONE_MATCH'):
+            return etag_matches(request, etag) or etag_matches(request, gzip_etag(etag))
+        
+        since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        
+        return since is not None and last_modified is not None and last_modified <= since
+
+    @staticmethod
+    def set_validators(response, etag, last_modified):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
     @staticmethod
     def cleanup_request(request):
         """
@@ -279,8 +575,11 @@ class Resource(object):
     def get_schema(self, schema):
         return schemas.get_schema(self.model, schema)
     
-    def get_schema_view(self, schema):
-        return schemas.get_schema_view(self.model, schema)
+    def get_schema_view(self, schema, request=None):
+        return schemas.get_schema_view(self.model, schema, request=request)
+    
+    def warm_schemas(self):
+        schemas.warm(self.model)
     
     def get_request_example(self, format):
         return 'import urllib\nurllib.urlopen()'
@@ -312,7 +611,7 @@ class ArbitraryResource(Resource):
     #callmap = { 'GET': 'read', 'POST': 'create', 
     #            'PUT': 'update', 'DELETE': 'delete' }
     
-    def __init__(self, handler, site, name=None, authentication=None, group=None):
+    def __init__(self, handler, site, name=None, authentication=None, group=None, **options):
         self.handler = handler
         self.site = site
         self.name = name.lower()
@@ -321,16 +620,15 @@ class ArbitraryResource(Resource):
         self.authentication = authentication
         self.arbitrary = True
         self.group = group
-        
-        # Erroring
-        self.email_errors = getattr(settings, 'FULCRUM_EMAIL_ERRORS', True)
-        self.display_errors = getattr(settings, 'FULCRUM_DISPLAY_ERRORS', True)
-        self.stream = getattr(settings, 'FULCRUM_STREAM_OUTPUT', False)
+        self.configure(**options)
         
     # def get_schema(self, schema):
     #     return '#'
     
     # def get_schema_view(self, schema):
     #     return '#'
+    
+    def warm_schemas(self):
+        pass
         
         
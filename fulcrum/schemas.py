@@ -25,7 +25,7 @@ OTHER DEALINGS IN THE SOFTWARE.
 
 import json
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 
 from django.db.models.fields import *
 from django.db.models.fields.files import FileField, ImageField
@@ -34,6 +34,12 @@ from django.db.models.fields.related import ForeignKey, ManyToManyField, OneToOn
 from xml.dom import getDOMImplementation
 impl = getDOMImplementation()
 
+from fulcrum.utils import get_etag, etag_matches
+
+# Rendered schema documents, keyed on (model, format, pretty).
+# Models only change on deploy, so these live for the process.
+_cache = {}
+
 class Schema:
     """
     An abstract class representing a schema for a particular model.
@@ -164,6 +170,74 @@ class XSDSchema(XMLSchema):
         self.root = root	# Prepare for printing
         
 
+# JSON Schema type and format of each model field class. Subclasses
+# not listed here take the entry of their nearest listed ancestor.
+FIELD_TYPES = {
+    AutoField: ("integer", None),
+    BigIntegerField: ("integer", None),
+    IntegerField: ("integer", None),
+    PositiveIntegerField: ("integer", None),
+    PositiveSmallIntegerField: ("integer", None),
+    SmallIntegerField: ("integer", None),
+    FloatField: ("number", None),
+    DecimalField: ("number", None),
+    BooleanField: ("boolean", None),
+    NullBooleanField: ("boolean", None),
+    CharField: ("string", None),
+    SlugField: ("string", None),
+    EmailField: ("string", None),
+    TextField: ("string", None),
+    URLField: ("string", None),
+    DateField: ("string", "date"),
+    TimeField: ("string", "time"),
+    DateTimeField: ("string", "date-time"),
+    FileField: ("file", None),
+    ImageField: ("image", None),
+    ForeignKey: ("object", None),
+    ManyToManyField: ("object", None),
+    OneToOneField: ("object", None),
+}
+
+def field_type(field):
+    """
+    Returns the `(type, format)` pair of `field` from `FIELD_TYPES`,
+    or `(None, None)` for field classes it doesn't know.
+    """
+    for cls in type(field).__mro__:
+        if cls in FIELD_TYPES:
+            return FIELD_TYPES[cls]
+    return (None, None)
+
+def field_info(field):
+    """
+    Returns the JSON Schema property describing `field`.
+    """
+    info = {}
+    type, format = field_type(field)
+    
+    if type is not None:
+        info["type"] = type
+    if format is not None:
+        info["format"] = format
+    if isinstance(field, CharField) and field.max_length is not None:
+        info["maxLength"] = field.max_length
+    
+    return info
+
+def indexed_fields(model):
+    """
+    Returns the names of the fields of `model` that lead an index,
+    so a lookup or grouping on them alone needn't scan the table.
+    ForeignKeys are indexed unless `db_index=False`.
+    """
+    opts = model._meta
+    names = set([ f.name for f in opts.fields if f.primary_key or f.unique or f.db_index ])
+    
+    for together in tuple(opts.index_together) + tuple(opts.unique_together):
+        names.add(together[0])
+    
+    return names
+
 class JSONSchema(Schema):
     """
     http://json-schema.org/
@@ -176,53 +250,7 @@ class JSONSchema(Schema):
         
         properties = {}
         for field in self.model._meta.fields:
-            info = {}
-            
-            cls = field.__class__
-            
-            if cls == AutoField:
-                info["type"] = "integer"
-            elif cls == CharField:
-                info["type"] = "string"
-                info["maxLength"] = field.max_length
-            elif cls == FloatField or cls == DecimalField:
-                info["type"] = "number"
-            elif cls == SlugField:
-                info["type"] = "string"
-            elif cls == EmailField:
-                info["type"] = "string"
-            elif cls == BigIntegerField or cls == IntegerField or cls == PositiveIntegerField or cls == PositiveSmallIntegerField or cls == SmallIntegerField:
-                info["type"] = "integer"
-            elif cls == BooleanField or cls == NullBooleanField:
-                info["type"] = "boolean"
-            elif cls == DateField:
-                info["type"] = "string"
-                info["format"] = "date"
-            elif cls == TimeField:
-                info["type"] = "string"
-                info["format"] = "time"
-            elif cls == DateTimeField:
-                info["type"] = "string"
-                info["format"] = "date-time"
-            elif cls == FileField:
-                info["type"] = "file"
-            elif cls == ImageField:
-                info["type"] = "image"
-            elif cls == TextField:
-                info["type"] = "string"
-            elif cls == URLField:
-                info["type"] = "string"
-            elif cls == XMLField:
-                info["type"] = "xml"
-            elif cls == ForeignKey:
-                info["type"] = "object"
-            elif cls == ManyToManyField:
-                info["type"] = "object"
-            elif cls == OneToOneField:
-                info["type"] = "object"
-                
-            
-            properties[field.name] = info
+            properties[field.name] = field_info(field)
         
         data["properties"] = properties
         
@@ -235,21 +263,58 @@ class JSONSchema(Schema):
             return json.dumps(self.data)
     
 
+def render_schema(model, format='json', pretty=True):
+    """
+    Returns a `(text, etag)` pair for the schema of `model`.
+    Schemas are built on first use and served from memory
+    afterwards. Raises `KeyError` for unknown formats.
+    """
+    key = (model, format, pretty)
+    
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    
+    cls, content_type = map[format]
+    text = cls(model).text(pretty=pretty)
+    _cache[key] = (text, get_etag(text))
+    
+    return _cache[key]
+
+
+def warm(model):
+    """
+    Renders every known schema format for `model` up front,
+    so the first request doesn't pay for it.
+    """
+    for format in map:
+        render_schema(model, format)
+
+
 def get_schema(model, format='json', pretty=True):
     try:
-        cls, content_type = map[format]
+        text, etag = render_schema(model, format, pretty)
     except KeyError:
         return 'The format you specified, %s, corresponds to no known schema type.' % format
-    return cls(model).text(pretty=pretty)
+    return text
     
     
-def get_schema_view(model, format, pretty=True):
+def get_schema_view(model, format, pretty=True, request=None):
     
     try:
-        cls, content_type = map[format]
+        text, etag = render_schema(model, format, pretty)
     except KeyError:
         return 'The format you specified, %s, corresponds to no known schema type.' % format
-    return HttpResponse(cls(model).text(pretty=pretty), content_type)
+    
+    if request is not None and etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        cls, content_type = map[format]
+        response = HttpResponse(text, content_type)
+    
+    response['ETag'] = etag
+    return response
 
 map = {
     'xsd': (XSDSchema, 'application/xml'),
@@ -1,16 +1,25 @@
-import os
+import os, re, copy, json, urllib
+from multiprocessing.pool import ThreadPool
 from django import http
-from django.db import models
+from django.core.urlresolvers import reverse
+from django.db import models, connections
+from django.utils.encoding import smart_str
 from django.shortcuts import render_to_response
+from django.conf import settings
 from functools import update_wrapper
 from django.utils.safestring import mark_safe
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.cache import never_cache
+from django.utils.cache import add_never_cache_headers
 from django.template import RequestContext
 from fulcrum.datastructures import EasyModel
 from fulcrum.authentication import NoAuthentication
 from fulcrum.handler import DefaultHandler, DefaultAnonymousHandler
 from fulcrum.resource import ArbitraryResource, Resource
+from fulcrum.doc import SiteDocumentation
+from fulcrum.utils import etag_matches, is_reserved_param, rc, file_response, HttpStatusCode
+from fulcrum.exports import get_export_manager, JOB_ID
+from fulcrum.emitters import Emitter
 from fulcrum import log
 from exceptions import Exception, KeyError
 
@@ -21,18 +30,30 @@ class AlreadyRegistered(Exception):
 class NotRegistered(Exception):
     pass
 
+# Paths accepted in batch sub-requests, relative to the site root.
+BATCH_PATH = re.compile(r'^(?P<resource_name>\w+)(?:/(?P<primary_key>\w+))?(?:\.(?P<format>\w+))?/?$')
+
+# Per-request headers, which sub-requests only get from their own `headers`.
+BATCH_HEADERS = ('HTTP_IDEMPOTENCY_KEY', 'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE',
+                 'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE', 'HTTP_IF_RANGE', 'HTTP_RANGE')
+
+# Default for options where None means "none", rather than "the site's".
+NOT_SET = object()
+
 class FulcrumSite(object):
     """
     Default fulcrum site.
     """
     
-    def __init__(self, name=None, app_name='fulcrum', authentication=None):
+    def __init__(self, name=None, app_name='fulcrum', authentication=None, throttle=None):
         if name is None: self.name = 'fulcrum'
         else: self.name = name
         self.app_name = app_name
         self.registry = {}
         self.authentication = authentication or NoAuthentication() # default authentication for all resources
+        self.throttle = throttle # default throttle for all resources
         self.group = 'Resources'
+        self._documentation = None
     
     
     def has_permission(self, request):
@@ -44,9 +65,12 @@ class FulcrumSite(object):
         return True
     
     
-    def register(self, model, handler_class=None, name=None, authentication=None, group=None, **options):
+    def register(self, model, handler_class=None, name=None, authentication=None, group=None, throttle=NOT_SET, **options):
         """
-        Register a resource.
+        Register a resource. Any extra `options`, such as a
+        `cache_policy`, are passed on to `Resource.configure`.
+        Resources get the site's throttle unless given their own,
+        or None (or False) for none.
         """
         if handler_class:
             handler = handler_class()
@@ -57,23 +81,32 @@ class FulcrumSite(object):
                 handler = DefaultAnonymousHandler(model)
         authentication = authentication or self.authentication
         group = group or self.group
-        resource = Resource(handler, self, name, authentication, group)
+        if throttle is NOT_SET:
+            throttle = self.throttle
+        resource = Resource(handler, self, name, authentication, group, throttle=throttle, **options)
         
         if resource.name in self.registry:
             raise AlreadyRegistered('The resource %s is already registered' % resource.name)
         self.registry[resource.name] = resource
+        self._documentation = None
+        
+        if getattr(settings, 'FULCRUM_WARM_SCHEMAS', False):
+            resource.warm_schemas()
     
     
-    def register_arbitrary(self, handler_class, name, authentication=None, group=None, **options):
+    def register_arbitrary(self, handler_class, name, authentication=None, group=None, throttle=NOT_SET, **options):
         """
         Register an aribitrary resource not tied to a model.
         """
         authentication = authentication or self.authentication
         group = group or self.group
-        resource = ArbitraryResource(handler_class(), self, name, authentication, group)
+        if throttle is NOT_SET:
+            throttle = self.throttle
+        resource = ArbitraryResource(handler_class(), self, name, authentication, group, throttle=throttle, **options)
         if resource.name in self.registry:
             raise AlreadyRegistered('The arbitrary resource %s is already registered' % resource.name)
         self.registry[resource.name] = resource
+        self._documentation = None
     
         
     def unregister(self, resource):
@@ -84,11 +117,22 @@ class FulcrumSite(object):
         if resource.name not in self.registry:
             raise NotRegistered('The resource %s has not been registered' % resource.name)
         del self.registry[resource.name]
+        self._documentation = None
     
     
     def get_resource_list(self):
         return self.registry.keys()
     
+    def get_documentation(self):
+        """
+        Returns the `SiteDocumentation` for this site, building
+        it on first use. Registering or unregistering a resource
+        discards it.
+        """
+        if self._documentation is None:
+            self._documentation = SiteDocumentation(self)
+        return self._documentation
+    
     def get_resource_by_model(self, model):
         """
         Get a resource by model.
@@ -107,13 +151,13 @@ class FulcrumSite(object):
         ``self.has_permission``.
         
         By default, fulcrum_views are marked non-cacheable using the
-        ``never_cache`` decorator. If the view can be safely cached, set
-        cacheable=True.
+        ``never_cache`` decorator. If the view can be safely cached, or
+        sets its own caching headers, set cacheable=True.
         """
         
         def inner(request, *args, **kwargs):
             if not self.has_permission(request):
-                return self.login(request)
+                return never_cache(self.login)(request)
             return view(request, *args, **kwargs)
         if not cacheable:
             inner = never_cache(inner)
@@ -131,22 +175,47 @@ class FulcrumSite(object):
             def wrapper(*args, **kwargs):
                 return self.fulcrum_view(view, cacheable)(*args, **kwargs)
             return update_wrapper(wrapper, view)
+        
+        def unless_object(view, option, primary_key):
+            # `<resource>/changes.json` is also the URL of an object with
+            # the primary key 'changes'. It only goes to `view` for
+            # resources registered with `option`.
+            object_view = wrap(self.object_data_format, cacheable=True)
+            def wrapper(request, resource_name, format):
+                resource = self.registry.get(resource_name)
+                if resource is None or not getattr(resource, option):
+                    return object_view(request, resource_name=resource_name,
+                                       primary_key=primary_key, format=format)
+                return view(request, resource_name=resource_name, format=format)
+            return update_wrapper(wrapper, view)
             
         urlpatterns = [
             url(r'^$', # root
                 wrap(self.index),
                 name='fulcrum_index'),
             
+            url(r'^schema\.json$', # ex: schema.json
+                wrap(self.api_description, cacheable=True),
+                name='fulcrum_api_description'),
+            
+            url(r'^schema\.(?P<digest>[0-9a-f]{32})\.json$', # ex: schema.<digest>.json
+                wrap(self.api_description, cacheable=True),
+                name='fulcrum_api_description'),
+            
+            url(r'^batch$', # batch
+                wrap(self.batch),
+                name='fulcrum_batch'),
+            
             url(r'^(?P<resource_name>\w+)$', # ex: resource_name
-                wrap(self.resource_data_format),
+                wrap(self.resource_data_format, cacheable=True),
                 name='fulcrum_resource_data_format'),
             
             url(r'^(?P<resource_name>\w+)/$', # ex: resource_name/
-                wrap(self.resource_data_format),
+                wrap(self.resource_data_format, cacheable=True),
                 name='fulcrum_resource_data_format'),
             
             url(r'^(?P<resource_name>\w+)\.(?P<format>\w+)$', # ex: resource_name.json
-                wrap(self.resource_data_format),
+                wrap(self.resource_data_format, cacheable=True),
                 name='fulcrum_resource_data_format'),
             
             url(r'^(?P<resource_name>\w+)/api$', # ex: resource_name/api
@@ -154,15 +223,31 @@ class FulcrumSite(object):
                 name='fulcrum_resource_api'),
             
             url(r'^(?P<resource_name>\w+)/schema\.(?P<format>\w+)$', # ex: resource_name/schema.json
-                wrap(self.resource_schema),
+                wrap(self.resource_schema, cacheable=True),
                 name='fulcrum_resource_schema'),
             
+            url(r'^(?P<resource_name>\w+)/changes\.(?P<format>\w+)$', # ex: resource_name/changes.json
+                unless_object(wrap(self.resource_changes, cacheable=True), 'changes', 'changes'),
+                name='fulcrum_resource_changes'),
+            
+            url(r'^(?P<resource_name>\w+)/export\.(?P<format>\w+)$', # ex: resource_name/export.json
+                unless_object(wrap(self.resource_export), 'exports', 'export'),
+                name='fulcrum_resource_export'),
+            
+            url(r'^(?P<resource_name>\w+)/exports/(?P<job_id>%s)$' % JOB_ID, # ex: resource_name/exports/<id>
+                wrap(self.export_status),
+                name='fulcrum_export_status'),
+            
+            url(r'^(?P<resource_name>\w+)/exports/(?P<job_id>%s)/download$' % JOB_ID, # ex: resource_name/exports/<id>/download
+                wrap(self.export_download),
+                name='fulcrum_export_download'),
+            
             url(r'^(?P<resource_name>\w+)/(?P<primary_key>\w+)$', # ex: resource_name/1
-                wrap(self.object_data_format),
+                wrap(self.object_data_format, cacheable=True),
                 name='fulcrum_object_data_format'),
             
             url(r'^(?P<resource_name>\w+)/(?P<primary_key>\w+)\.(?P<format>\w+)$', # ex: resource_name/1.json
-                wrap(self.object_data_format),
+                wrap(self.object_data_format, cacheable=True),
                 name='fulcrum_object_data_format'),
         ]
         
@@ -188,29 +273,259 @@ class FulcrumSite(object):
                                   context_instance=RequestContext(request))
         
     
+    def api_description(self, request, digest=None):
+        """
+        Site-wide API description covering every registered resource.
+        
+        `schema.json` always answers with the current document and
+        points at its digest-named copy in `Content-Location`. The
+        digest-named copy never changes, so it may be cached forever.
+        """
+        
+        log.debug('api_description()')
+        
+        doc = self.get_documentation()
+        
+        if digest is not None and digest != doc.digest:
+            return http.HttpResponseRedirect('schema.%s.json' % doc.digest)
+        
+        if etag_matches(request, doc.etag):
+            response = http.HttpResponseNotModified()
+        else:
+            response = http.HttpResponse(doc.text, content_type='application/json; charset=utf-8')
+        
+        response['ETag'] = doc.etag
+        
+        if digest is None:
+            response['Content-Location'] = 'schema.%s.json' % doc.digest
+        else:
+            response['Cache-Control'] = 'public, max-age=31536000'
+        
+        return response
+    
+    
+    def batch(self, request):
+        """
+        Runs several resource requests in one HTTP call. POST a JSON
+        list of sub-requests (or an object with a `requests` list):
+        
+            [{"method": "GET", "path": "blogpost/1.json"},
+             {"method": "GET", "path": "tags.json", "params": {"name": "news"}},
+             {"method": "POST", "path": "tags.json", "body": {"name": "sports"}}]
+        
+        `path` is relative to the site root and defaults to JSON output.
+        `params` become the query string. `body` is what a JSON
+        request would send, or a string of form-encoded fields.
+        `headers` can give a sub-request its own `Idempotency-Key`,
+        `If-None-Match`, `If-Modified-Since` or `Range`; those of the
+        batch itself don't carry over.
+        
+        Each authentication scheme involved runs once for the whole
+        batch. Sub-requests run in order; if `FULCRUM_BATCH_THREADS`
+        is set and every sub-request is a GET, they run on a pool of
+        that many threads. At most `FULCRUM_BATCH_LIMIT` (default 25)
+        sub-requests are accepted.
+        
+        Returns a list of `{"status", "headers", "body"}` entries in
+        the same order. JSON bodies are embedded as they are.
+        """
+        
+        log.debug('batch()')
+        
+        if request.method != 'POST':
+            return http.HttpResponseNotAllowed(['POST'])
+        
+        try:
+            specs = json.loads(request.body)
+        except ValueError:
+            return rc.BAD_REQUEST
+        
+        if isinstance(specs, dict):
+            specs = specs.get('requests')
+        
+        if not isinstance(specs, list) or not all(isinstance(s, dict) for s in specs):
+            return rc.BAD_REQUEST
+        
+        limit = getattr(settings, 'FULCRUM_BATCH_LIMIT', 25)
+        
+        if len(specs) > limit:
+            resp = rc.REQUEST_TOO_LARGE
+            resp.content = 'At most %d requests are allowed per batch.' % limit
+            return resp
+        
+        memo = { }
+        subrequests = [ self.batch_subrequest(request, spec, memo) for spec in specs ]
+        threads = getattr(settings, 'FULCRUM_BATCH_THREADS', 0)
+        
+        if threads and len(subrequests) > 1 and all(s.method == 'GET' for s in subrequests):
+            # Authenticate up front, so the threads only ever read the memo.
+            for sub in subrequests:
+                resource = self.registry.get(getattr(sub, 'batch_match', {}).get('resource_name'))
+                if resource is not None:
+                    resource.is_authenticated(sub)
+            
+            pool = ThreadPool(min(threads, len(subrequests)))
+            try:
+                entries = pool.map(self.batch_threaded, subrequests)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            entries = map(self.batch_dispatch, subrequests)
+        
+        return http.HttpResponse('[%s]' % ', '.join(entries),
+                                 content_type='application/json; charset=utf-8')
+    
+    
+    def batch_subrequest(self, request, spec, memo):
+        """
+        Builds a sub-request for `batch` from its JSON description.
+        """
+        method = str(spec.get('method', 'GET')).upper()
+        path = str(spec.get('path', '')).lstrip('/')
+        params = spec.get('params') or { }
+        body = spec.get('body')
+        headers = spec.get('headers') or { }
+        
+        sub = copy.copy(request)
+        sub.method = method
+        sub.fulcrum_auth = memo
+        sub.path = sub.path_info = request.path[:-len('batch')] + path
+        
+        query = urllib.urlencode([ (smart_str(k), smart_str(v)) for k, v in params.items() ]
+                                 if isinstance(params, dict) else [])
+        
+        sub.META = request.META.copy()
+        sub.META['REQUEST_METHOD'] = method
+        sub.META['QUERY_STRING'] = query
+        sub.META['PATH_INFO'] = sub.path_info
+        # Entries are embedded in the batch response, which gets its own encoding.
+        sub.META.pop('HTTP_ACCEPT_ENCODING', None)
+        
+        # These are about the batch request, not its entries.
+        for name in BATCH_HEADERS:
+            sub.META.pop(name, None)
+        
+        if isinstance(headers, dict):
+            for k, v in headers.items():
+                name = 'HTTP_%s' % str(k).upper().replace('-', '_')
+                if name in BATCH_HEADERS:
+                    sub.META[name] = smart_str(v)
+        sub.GET = http.QueryDict(query)
+        sub.POST = http.QueryDict('')
+        sub.data = None
+        
+        sub.idempotency_body = json.dumps(body, sort_keys=True)
+        
+        # JSON bodies are handed over already decoded, as `request.data`
+        # with their types intact; `Mimer` leaves decoded requests alone.
+        # A string body is form data.
+        if isinstance(body, (dict, list)):
+            sub.META['CONTENT_TYPE'] = 'application/json; charset=utf-8'
+            sub.data = body
+        else:
+            sub.META['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+            if isinstance(body, basestring):
+                sub.POST = http.QueryDict(smart_str(body))
+        
+        if method in ('PUT', 'PATCH'):
+            sub.PUT = sub.POST
+        
+        match = BATCH_PATH.match(path)
+        if match:
+            sub.batch_match = match.groupdict()
+        
+        return sub
+    
+    
+    def batch_dispatch(self, sub):
+        """
+        Runs one `batch` sub-request, returns its encoded entry.
+        """
+        match = getattr(sub, 'batch_match', None)
+        
+        if match is None or match['resource_name'] not in self.registry:
+            return self.batch_entry(rc.NOT_FOUND)
+        
+        format = match['format'] or 'json'
+        
+        try:
+            if match['primary_key']:
+                response = self.object_data_format(sub, match['resource_name'],
+                                                   match['primary_key'], format)
+            else:
+                response = self.resource_data_format(sub, match['resource_name'], format)
+        except http.Http404:
+            response = rc.NOT_FOUND
+        except Exception, e:
+            log.error('batch(): %s' % e)
+            response = http.HttpResponseServerError('Internal Server Error')
+        
+        return self.batch_entry(response, json_body=not sub.GET.get('callback'))
+    
+    
+    def batch_threaded(self, sub):
+        try:
+            return self.batch_dispatch(sub)
+        finally:
+            for connection in connections.all():
+                connection.close()
+    
+    
+    def batch_entry(self, response, json_body=True):
+        if getattr(response, 'streaming', False) and hasattr(response, 'streaming_content'):
+            content = ''.join(response.streaming_content)
+        else:
+            content = response.content
+        
+        content_type = response.get('Content-Type', '')
+        
+        if json_body and content and content_type.startswith('application/json'):
+            body = content
+        else:
+            body = json.dumps(content.decode('utf-8', 'replace'))
+        
+        head = json.dumps({ 'status': response.status_code, 'headers': dict(response.items()) })
+        
+        return '%s, "body": %s}' % (head[:-1], body)
+    
+    
+    def not_found(self, request, error_msg):
+        """
+        The 404 page, never cached, whatever view it comes from.
+        """
+        response = render_to_response('fulcrum/404_fulcrum.html',
+                                      { 'error_msg': error_msg },
+                                      context_instance=RequestContext(request),
+                                      status=404)
+        add_never_cache_headers(response)
+        return response
+    
     def login(self, request):
         return http.HttpResponse('login')
     
         
-    def resource_data_format(self, request, resource_name, format='html', *args, **kwargs):
+    def resource_data_format(self, request, resource_name, format=None, *args, **kwargs):
         """
-        Resource data
+        Resource data. Without a format in the URL or query string,
+        it's negotiated from `Accept`, and defaults to the HTML page.
         """
         
         log.debug('resource_data_format(): %s' % format)
         
         for k, v in request.GET.items():
-            kwargs[str(k)] = str(v)
+            if is_reserved_param(k):
+                continue
+            # Values are coerced by the handler, see `BaseHandler.clean_filters`.
+            kwargs[str(k)] = v
         
         try:
             resource = self.registry[resource_name]
         except KeyError:
             error_msg = "Sorry, but no resource with the name <span class='loud'>{0}</span> has been registered with Fulcrum.".format(resource_name)
-            return render_to_response('fulcrum/404_fulcrum.html',
-                                      { 'error_msg': error_msg },
-                                      context_instance=RequestContext(request))
+            return self.not_found(request, error_msg)
         
-        return resource.handle(request, emitter_format=format, *args, **kwargs)
+        return resource.handle(request, emitter_format=format, default_format='html', *args, **kwargs)
     
     
     def resource_api(self, request, resource_name, *args, **kwargs):
@@ -224,9 +539,7 @@ class FulcrumSite(object):
             resource = self.registry[resource_name]
         except KeyError:
             error_msg = "Sorry, but no resource with the name <span class='loud'>{0}</span> has been registered with Fulcrum.".format(resource_name)
-            return render_to_response('fulcrum/404_fulcrum.html',
-                                      { 'error_msg': error_msg },
-                                      context_instance=RequestContext(request))
+            return self.not_found(request, error_msg)
         
         
         protocol = request.META['SERVER_PROTOCOL'].split('/')[0].lower()
@@ -250,17 +563,139 @@ class FulcrumSite(object):
             resource = self.registry[resource_name]
         except KeyError:
             error_msg = "Sorry, but no resource with the name <span class='loud'>{0}</span> has been registered with Fulcrum.".format(resource_name)
-            return render_to_response('fulcrum/404_fulcrum.html',
-                                      { 'error_msg': error_msg },
-                                      context_instance=RequestContext(request))
+            return self.not_found(request, error_msg)
             #raise http.Http404("This resource has not been registered with fulcrum.")
         
-        return resource.get_schema_view(format)
+        return resource.get_schema_view(format, request)
+        
+    
+    def resource_changes(self, request, resource_name, format):
+        """
+        The changes feed of a resource registered with `changes=True`,
+        see `BaseHandler.changes`.
+        """
+        resource = self.registry.get(resource_name)
+        
+        if resource is None or not resource.changes:
+            raise http.Http404
+        
+        if request.method != 'GET':
+            return http.HttpResponseNotAllowed(['GET'])
+        
+        return resource.handle(request, emitter_format=format, handler_method='changes')
+    
+    
+    def resource_export(self, request, resource_name, format):
+        """
+        Queues a background export of a resource, taking the same filters
+        as `resource_data_format`. Answers 202, with the job's status URL
+        in `Location`.
+        """
+        resource = self.registry.get(resource_name)
+        
+        if resource is None or not resource.exports:
+            raise http.Http404
+        
+        if request.method != 'POST':
+            return http.HttpResponseNotAllowed(['POST'])
+        
+        try:
+            Emitter.get(format)
+        except ValueError:
+            return rc.BAD_REQUEST
+        
+        served = resource.get_handler(request, 'GET')
+        if served is None:
+            return resource.authentication.challenge()
+        handler, anonymous = served
+        
+        filters = dict([ (str(k), v) for k, v in request.GET.items() if not is_reserved_param(k) ])
+        
+        # Turn bad filters away now, rather than fail the job later.
+        try:
+            handler.clean_filters(filters)
+        except HttpStatusCode, e:
+            return e.response
+        
+        manager = get_export_manager()
+        status = manager.submit(resource, manager.snapshot(request), handler, anonymous, format, filters)
+        
+        response = self.export_response(request, resource_name, status, status=202)
+        response['Location'] = request.build_absolute_uri(
+            reverse('%s:fulcrum_export_status' % self.name,
+                    kwargs={ 'resource_name': resource_name, 'job_id': status['id'] }))
+        return response
+    
+    
+    def export_status(self, request, resource_name, job_id):
+        """
+        Reports on an export job. Once it's done, `download` links the file.
+        """
+        status = self.get_export(request, resource_name, job_id)
+        
+        if status is None:
+            return rc.NOT_FOUND
+        
+        return self.export_response(request, resource_name, status)
+    
+    
+    def export_download(self, request, resource_name, job_id):
+        """
+        Serves the file of a finished export job, with `Range` support.
+        """
+        status = self.get_export(request, resource_name, job_id)
+        
+        if status is None or status['status'] != 'done':
+            return rc.NOT_FOUND
         
+        manager = get_export_manager()
+        path = manager.path(job_id, status['format'])
+        filename = '%s.%s' % (resource_name, status['format'])
+        
+        try:
+            return file_response(request, path, status['content_type'], filename)
+        except (OSError, IOError):
+            # Pruned from under a status that's still around.
+            manager.discard(job_id)
+            resp = rc.NOT_HERE
+            resp.write(' This export has expired.')
+            return resp
+    
+    
+    def get_export(self, request, resource_name, job_id):
+        """
+        Returns the status of a job of `resource_name`, if the request may see it.
+        """
+        resource = self.registry.get(resource_name)
+        
+        if resource is None or not resource.exports or resource.get_handler(request, 'GET') is None:
+            return None
+        
+        status = get_export_manager().status(job_id)
+        
+        if status is None or status['resource'] != resource.name:
+            return None
+        
+        if status['user'] is not None and status['user'] != getattr(request.user, 'pk', None):
+            return None
+        
+        return status
+    
     
-    def object_data_format(self, request, resource_name, primary_key, format='html', *args, **kwargs):
+    def export_response(self, request, resource_name, status, **kwargs):
+        data = dict(status)
+        
+        if data['status'] == 'done':
+            data['download'] = request.build_absolute_uri(
+                reverse('%s:fulcrum_export_download' % self.name,
+                        kwargs={ 'resource_name': resource_name, 'job_id': status['id'] }))
+        
+        return http.HttpResponse(json.dumps(data), content_type='application/json; charset=utf-8', **kwargs)
+    
+    
+    def object_data_format(self, request, resource_name, primary_key, format=None, *args, **kwargs):
         """
-        Object data
+        Object data, negotiated like `resource_data_format`.
         """
         
         log.debug('object_data_format()')
@@ -269,21 +704,20 @@ class FulcrumSite(object):
             resource = self.registry[resource_name]
         except KeyError:
             error_msg = "Sorry, but no resource with the name <span class='loud'>{0}</span> has been registered with Fulcrum.".format(resource_name)
-            return render_to_response('fulcrum/404_fulcrum.html',
-                                      { 'error_msg': error_msg },
-                                      context_instance=RequestContext(request))
+            return self.not_found(request, error_msg)
+        
+        format = resource.determine_emitter(request, emitter_format=format, default_format='html')
         
         if format == 'html':
             try:
                 object = resource.object_by_pk(primary_key)
             except:
                 error_msg = "Sorry, but Fulcrum can't find an object with a primary key of <span class='loud'>{0}</span>.".format(primary_key)
-                return render_to_response('fulcrum/404_fulcrum.html',
-                                          { 'error_msg': error_msg },
+                return self.not_found(request, error_msg)
+            response = render_to_response('fulcrum/object_detail.html',
+                                          { 'object': object },
                                           context_instance=RequestContext(request))
-            return render_to_response('fulcrum/object_detail.html',
-                                      { 'object': object },
-                                      context_instance=RequestContext(request))
+            return resource.cache_policy.apply(request, response)
         else:
             return resource.handle(request, pk=primary_key, emitter_format=format)
             
@@ -1,6 +1,12 @@
+import hashlib
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils.encoding import smart_str
+
 import oauth
 
-from models import Nonce, Token, Consumer
+from models import Nonce, Token, Consumer, consumer_cache, token_cache
 
 class DataStore(oauth.OAuthDataStore):
     """Layer between Python OAuth and Django database."""
@@ -10,34 +16,60 @@ class DataStore(oauth.OAuthDataStore):
         self.scope = oauth_request.parameters.get('scope', 'all')
 
     def lookup_consumer(self, key):
-        try:
-            self.consumer = Consumer.objects.get(key=key)
-            return self.consumer
-        except Consumer.DoesNotExist:
-            return None
+        consumer = consumer_cache.get(key)
+        if consumer is None:
+            try:
+                consumer = Consumer.objects.get(key=key)
+            except Consumer.DoesNotExist:
+                return None
+            consumer_cache.set(key, consumer)
+        self.consumer = consumer
+        return self.consumer
 
     def lookup_token(self, token_type, token):
+        """
+        Access tokens are served from `token_cache`, with their
+        consumer and user attached. Request tokens change state
+        during the authorization dance and always hit the database.
+        """
         if token_type == 'request':
             token_type = Token.REQUEST
         elif token_type == 'access':
             token_type = Token.ACCESS
+        
+        cache_key = Token.cache_key(token, token_type)
+        
+        if token_type == Token.ACCESS:
+            self.request_token = token_cache.get(cache_key)
+            if self.request_token is not None:
+                return self.request_token
         try:
-            self.request_token = Token.objects.get(key=token, 
-                                                   token_type=token_type)
-            return self.request_token
+            self.request_token = Token.objects.select_related('consumer', 'user') \
+                                              .get(key=token, token_type=token_type)
         except Token.DoesNotExist:
             return None
+        
+        if token_type == Token.ACCESS:
+            token_cache.set(cache_key, self.request_token)
+        return self.request_token
 
     def lookup_nonce(self, oauth_consumer, oauth_token, nonce):
+        """
+        Records the nonce, relying on the unique constraint on
+        `Nonce` to detect replays. Returns the nonce if it was
+        seen before, None otherwise.
+        """
         if oauth_token is None:
             return None
-        nonce, created = Nonce.objects.get_or_create(consumer_key=oauth_consumer.key, 
-                                                     token_key=oauth_token.key,
-                                                     key=nonce)
-        if created:
+        try:
+            with transaction.atomic():
+                Nonce.objects.create(consumer_key=oauth_consumer.key, 
+                                     token_key=oauth_token.key,
+                                     key=nonce,
+                                     timestamp=int(self.timestamp or 0))
             return None
-        else:
-            return nonce.key
+        except IntegrityError:
+            return nonce
 
     def fetch_request_token(self, oauth_consumer):
         if oauth_consumer.key == self.consumer.key:
@@ -65,4 +97,26 @@ class DataStore(oauth.OAuthDataStore):
             self.request_token.user = user
             self.request_token.save()
             return self.request_token
-        return None
\ No newline at end of file
+        return None
+
+
+class CacheDataStore(DataStore):
+    """
+    `DataStore` that keeps nonces in Django's cache instead
+    of the database. Entries expire once the timestamp they
+    came with falls outside `OAuthServer.timestamp_threshold`.
+    
+    Select it with:
+    
+        OAUTH_DATA_STORE = 'fulcrum.store.CacheDataStore'
+    """
+    def lookup_nonce(self, oauth_consumer, oauth_token, nonce):
+        if oauth_token is None:
+            return None
+        
+        digest = hashlib.md5(smart_str('%s:%s:%s' % (oauth_consumer.key, oauth_token.key, nonce))).hexdigest()
+        
+        # `add` is atomic, and fails if the key is already there.
+        if cache.add('fulcrum:nonce:%s' % digest, 1, oauth.OAuthServer.timestamp_threshold):
+            return None
+        return nonce
@@ -0,0 +1,151 @@
+"""
+Request throttling for resources. Attach a `Throttle` to a
+site or resource:
+
+    fulcrum.site.register(Blogpost, throttle=Throttle(100, 60))
+"""
+
+import math, threading, time
+
+from django.core.cache import cache
+
+class Throttle(object):
+    """
+    Sliding-window rate limiter backed by Django's cache.
+    
+    Requests are counted in fixed windows with an atomic
+    `incr`; the previous window's count is weighted by how
+    much of it still overlaps the sliding window. Each check
+    costs one `incr` and one `get`.
+    
+    Parameters::
+     - `max_requests`: Requests allowed per window.
+     - `window`: Length of the window in seconds (default: 1 minute)
+     - `scope`: Bucket name. Defaults to the resource name, so
+       every resource is counted separately. Give several
+       throttles the same scope to share one bucket.
+     - `local_batch`: If greater than 1, hits are counted in
+       process and only sent to the cache every `local_batch`
+       hits, and the finished previous window is remembered
+       locally. Fewer round trips, at the cost of admitting up
+       to `local_batch` extra requests per process.
+    """
+    def __init__(self, max_requests, window=60, scope=None, local_batch=1):
+        self.max_requests = max_requests
+        self.window = window
+        self.scope = scope
+        self.local_batch = local_batch
+        
+        self._lock = threading.Lock()
+        self._index = None
+        self._pending = { }
+        self._totals = { }
+        self._previous = { }
+        
+    def identify(self, request):
+        """
+        Identifies the caller: the user if there is one,
+        otherwise the originating IP address.
+        """
+        user = getattr(request, 'user', None)
+        
+        if user is not None and user.is_authenticated():
+            ident = 'user:%s' % user.pk
+        else:
+            ident = request.META.get('REMOTE_ADDR', '')
+        
+        if hasattr(request, 'throttle_extra'):
+            """
+            Since we want to be able to throttle on a per-
+            application basis, it's important that we realize
+            that `throttle_extra` might be set on the request
+            object. If so, append the identifier name with it.
+            """
+            ident += ':%s' % str(request.throttle_extra)
+        
+        return ident
+    
+    def _incr(self, key, delta=1):
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            # First hit in this window. `add` only succeeds for
+            # one caller; everyone else goes back to `incr`.
+            if cache.add(key, delta, self.window * 2):
+                return delta
+            return cache.incr(key, delta)
+    
+    def _roll(self, index):
+        """
+        Forgets local counts when a new window starts.
+        """
+        with self._lock:
+            if self._index != index:
+                self._index = index
+                self._pending.clear()
+                self._totals.clear()
+                self._previous.clear()
+    
+    def count(self, key):
+        """
+        Counts one hit on `key`, returns the window total.
+        """
+        if self.local_batch <= 1:
+            return self._incr(key)
+        
+        with self._lock:
+            pending = self._pending.get(key, 0) + 1
+            if pending < self.local_batch:
+                self._pending[key] = pending
+                return self._totals.get(key, 0) + pending
+            self._pending.pop(key, None)
+        
+        total = self._incr(key, pending)
+        
+        with self._lock:
+            self._totals[key] = total
+        return total
+    
+    def previous(self, key):
+        """
+        Returns the total for the window before this one.
+        """
+        if self.local_batch <= 1:
+            return cache.get(key, 0)
+        
+        with self._lock:
+            if key in self._previous:
+                return self._previous[key]
+        
+        total = cache.get(key, 0)
+        
+        with self._lock:
+            self._previous[key] = total
+        return total
+    
+    def check(self, request, scope=''):
+        """
+        Counts the request. Returns None if it is allowed,
+        otherwise the number of seconds to wait before retrying.
+        """
+        index, offset = divmod(time.time(), self.window)
+        index = int(index)
+        
+        if self.local_batch > 1:
+            self._roll(index)
+        
+        base = 'fulcrum:throttle:%s:%s:' % (self.scope or scope, self.identify(request))
+        
+        current = self.count(base + str(index))
+        previous = self.previous(base + str(index - 1))
+        
+        if previous * (1 - offset / self.window) + current <= self.max_requests:
+            return None
+        
+        if current >= self.max_requests or not previous:
+            return int(math.ceil(self.window - offset))
+        
+        # The weight of the previous window has to drop far
+        # enough for `current` to fit under the limit.
+        needed = 1 - float(self.max_requests - current) / previous
+        return max(1, int(math.ceil(needed * self.window - offset)))
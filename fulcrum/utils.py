@@ -1,10 +1,13 @@
 from django.http import HttpResponseNotAllowed, HttpResponseForbidden, HttpResponse, HttpResponseBadRequest
+from django.http import StreamingHttpResponse, FileResponse
 from django.core.urlresolvers import reverse
-from django.core.cache import cache
+from django.conf import settings
+from django.utils.encoding import smart_str
 from django import get_version as django_version
 from decorator import decorator
+from throttling import Throttle
 
-from datetime import datetime, timedelta
+import hashlib, itertools, os, re, zlib
 
 __version__ = '0.2.2'
 
@@ -27,6 +30,8 @@ class rc_factory(object):
                  NOT_FOUND = ('Not Found', 404),
                  DUPLICATE_ENTRY = ('Conflict/Duplicate', 409),
                  NOT_HERE = ('Gone', 410),
+                 REQUEST_TOO_LARGE = ('Request Entity Too Large', 413),
+                 UNPROCESSABLE_ENTITY = ('Unprocessable Entity', 422),
                  NOT_IMPLEMENTED = ('Not Implemented', 501),
                  THROTTLED = ('Throttled', 503))
 
@@ -44,6 +49,13 @@ class rc_factory(object):
         return HttpResponse(r, content_type='text/plain', status=c)
     
 rc = rc_factory()
+
+# Query string parameters that control how a request is
+# handled, rather than filter the objects it applies to.
+RESERVED_PARAMS = ('format', 'callback', 'recurse', 'dry_run', 'count', 'aggregate', 'group_by')
+
+def is_reserved_param(name):
+    return name in RESERVED_PARAMS or name.startswith('oauth_')
     
 class FormValidationError(Exception):
     def __init__(self, form):
@@ -53,6 +65,13 @@ class HttpStatusCode(Exception):
     def __init__(self, response):
         self.response = response
 
+class RequestTooLarge(HttpStatusCode):
+    """
+    Raised when a request body is larger than `FULCRUM_MAX_BODY_SIZE`.
+    """
+    def __init__(self):
+        HttpStatusCode.__init__(self, rc.REQUEST_TOO_LARGE)
+
 def validate(v_form, operation='POST'):
     @decorator
     def wrap(f, self, request, *a, **kwa):
@@ -64,66 +83,82 @@ def validate(v_form, operation='POST'):
             raise FormValidationError(form)
     return wrap
 
+def throttled(wait):
+    """
+    Returns a `rc.THROTTLED` response asking the client
+    to come back in `wait` seconds.
+    """
+    t = rc.THROTTLED
+    t.content = 'Throttled, wait %d seconds.' % wait
+    t['Retry-After'] = str(wait)
+    return t
+
 def throttle(max_requests, timeout=60*60, extra=''):
     """
-    Simple throttling decorator, caches
-    the amount of requests made in cache.
+    Simple throttling decorator, counts the requests
+    made in cache (see `fulcrum.throttling.Throttle`.)
     
     If used on a view where users are required to
-    log in, the username is used, otherwise the
+    log in, the user is used, otherwise the
     IP address of the originating request is used.
     
+    Throttling can also be configured for a whole site
+    or resource with `FulcrumSite.register(throttle=...)`,
+    which does not need decorating every handler method.
+    
     Parameters::
      - `max_requests`: The maximum number of requests
-     - `timeout`: The timeout for the cache entry (default: 1 hour)
+     - `timeout`: The length of the window (default: 1 hour)
     """
+    limiter = Throttle(max_requests, timeout, scope='decorator:%s' % extra)
+    
     @decorator
     def wrap(f, self, request, *args, **kwargs):
-        if request.user.is_authenticated():
-            ident = request.user.username
-        else:
-            ident = request.META.get('REMOTE_ADDR', None)
-    
-        if hasattr(request, 'throttle_extra'):
-            """
-            Since we want to be able to throttle on a per-
-            application basis, it's important that we realize
-            that `throttle_extra` might be set on the request
-            object. If so, append the identifier name with it.
-            """
-            ident += ':%s' % str(request.throttle_extra)
+        wait = limiter.check(request)
         
-        if ident:
-            """
-            Preferrably we'd use incr/decr here, since they're
-            atomic in memcached, but it's in django-trunk so we
-            can't use it yet. If someone sees this after it's in
-            stable, you can change it here.
-            """
-            ident += ':%s' % extra
-    
-            now = datetime.now()
-            ts_key = 'throttle:ts:%s' % ident
-            timestamp = cache.get(ts_key)
-            offset = now + timedelta(seconds=timeout)
-    
-            if timestamp and timestamp < offset:
-                t = rc.THROTTLED
-                wait = timeout - (offset-timestamp).seconds
-                t.content = 'Throttled, wait %d seconds.' % wait
-                
-                return t
-                
-            count = cache.get(ident, 1)
-            cache.set(ident, count+1)
-            
-            if count >= max_requests:
-                cache.set(ts_key, offset, timeout)
-                cache.set(ident, 1)
+        if wait is not None:
+            return throttled(wait)
     
         return f(self, request, *args, **kwargs)
     return wrap
 
+def chunked(iterable, size):
+    """
+    Yields lists of up to `size` items from `iterable`,
+    without loading more than one list at a time.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def get_etag(content):
+    """
+    Returns a strong entity tag for `content`, suitable
+    for the `ETag` header.
+    """
+    return '"%s"' % hashlib.md5(smart_str(content)).hexdigest()
+
+def etag_matches(request, etag):
+    """
+    Checks `etag` against the `If-None-Match` header sent
+    by the client. Uses the weak comparison function, as
+    required for `If-None-Match`.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH', None)
+    
+    if not header:
+        return False
+    
+    if header.strip() == '*':
+        return True
+    
+    strip = lambda e: e[2:] if e.startswith('W/') else e
+    
+    return strip(etag) in [ strip(e.strip()) for e in header.split(',') ]
+
 def coerce_put_post(request):
     """
     Django doesn't particularly understand REST.
@@ -133,28 +168,293 @@ def coerce_put_post(request):
     
     The try/except abominiation here is due to a bug
     in mod_python. This should fix it.
+    
+    PATCH data is loaded the same way, and also ends
+    up on `request.PUT`. Requests that already have
+    `PUT` set (such as batch sub-requests) are left alone.
     """
-    if request.method == "PUT":
+    if request.method in ("PUT", "PATCH") and not hasattr(request, 'PUT'):
+        method = request.method
         try:
             request.method = "POST"
             request._load_post_and_files()
-            request.method = "PUT"
+            request.method = method
         except AttributeError:
             request.META['REQUEST_METHOD'] = 'POST'
             request._load_post_and_files()
-            request.META['REQUEST_METHOD'] = 'PUT'
+            request.META['REQUEST_METHOD'] = method
             
         request.PUT = request.POST
 
 
+def media_type(value):
+    """
+    Returns the bare, lowercased media type of a `Content-Type`
+    or `Accept` entry, e.g. 'application/json' for
+    'Application/JSON; charset=utf-8'.
+    """
+    return value.split(';', 1)[0].strip().lower()
+
+def parse_accept(header):
+    """
+    Parses an `Accept` header into a list of `(media_range, q)` pairs,
+    best first. Ranges with equal q keep the order they were sent in,
+    and ranges with a q of 0 are dropped.
+    """
+    ranges = []
+    
+    for position, entry in enumerate(header.split(',')):
+        parts = entry.split(';')
+        mime = media_type(parts[0])
+        if not mime:
+            continue
+        
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        
+        if q > 0:
+            ranges.append((-q, position, mime))
+    
+    return [ (media_range, -neg_q) for neg_q, position, media_range in sorted(ranges) ]
+
+def accepts_gzip(request):
+    """
+    Whether the client's `Accept-Encoding` allows gzip,
+    either by name or through `*`, with a q above 0.
+    """
+    codings = dict(parse_accept(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+    
+    if 'gzip' in codings:
+        return True
+    
+    # parse_accept drops q=0 entries, so look for an explicit refusal.
+    return '*' in codings and 'gzip' not in request.META.get('HTTP_ACCEPT_ENCODING', '').lower()
+
+def gzip_stream(chunks, level=6):
+    """
+    Gzips an iterable of byte strings as it goes, yielding
+    compressed chunks. Memory use is bounded by zlib's window,
+    whatever the length of the input.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    
+    for chunk in chunks:
+        data = compressor.compress(smart_str(chunk))
+        if data:
+            yield data
+    
+    yield compressor.flush()
+
+def gzip_etag(etag):
+    """
+    The entity tag of the gzipped variant of a response,
+    which must differ from that of the identity one.
+    """
+    return '%s-gzip"' % etag[:-1]
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """
+    Parses a single-range `Range` header against a body of `size`
+    bytes. Returns `(start, end)`, inclusive, False when the range
+    can't be satisfied, or None when there's no range to honour
+    (missing, malformed, or multiple ranges).
+    """
+    match = RANGE_RE.match(header.strip().replace(' ', ''))
+    if match is None or match.groups() == ('', ''):
+        return None
+    
+    first, last = match.groups()
+    
+    if not first:
+        # A suffix range: the last `last` bytes.
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        if last:
+            end = min(int(last), size - 1)
+        else:
+            end = size - 1
+        if last and int(last) < start:
+            return None
+    
+    if start >= size or end < start:
+        return False
+    
+    return start, end
+
+def read_range(f, length, block_size=64 * 1024):
+    """
+    Yields `length` bytes from the open file `f` in
+    blocks, and closes it when done.
+    """
+    try:
+        while length > 0:
+            data = f.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+def sendfile_response(path, content_type):
+    """
+    Hands serving the file at `path` over to the web server, as set
+    up by `FULCRUM_SENDFILE`:
+    
+     - 'x-sendfile' (Apache mod_xsendfile, lighttpd): the file's path
+       goes in an `X-Sendfile` header.
+     - 'x-accel-redirect' (nginx): the file must be under one of the
+       directories in `FULCRUM_SENDFILE_URLS`, a dict mapping them to
+       the internal locations they are served from.
+    
+    Returns None when there's nothing to offload to.
+    """
+    method = getattr(settings, 'FULCRUM_SENDFILE', None)
+    path = os.path.abspath(path)
+    
+    if method == 'x-sendfile':
+        header, value = 'X-Sendfile', path
+    elif method == 'x-accel-redirect':
+        header, value = 'X-Accel-Redirect', None
+        for root, location in getattr(settings, 'FULCRUM_SENDFILE_URLS', {}).items():
+            root = os.path.join(os.path.abspath(root), '')
+            if path.startswith(root):
+                value = location.rstrip('/') + '/' + path[len(root):]
+                break
+        if value is None:
+            return None
+    else:
+        return None
+    
+    response = HttpResponse(content_type=content_type)
+    response[header] = value
+    return response
+
+def file_response(request, path, content_type, filename=None):
+    """
+    Serves the file at `path` without reading it into memory: through
+    the web server if `FULCRUM_SENDFILE` is set (see
+    `sendfile_response`), or else from Python, honouring a `Range`
+    header with a 206, or a 416 if it can't be satisfied.
+    """
+    response = sendfile_response(path, content_type)
+    
+    if response is not None:
+        if filename:
+            response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+    
+    size = os.path.getsize(path)
+    byte_range = parse_range(request.META.get('HTTP_RANGE', ''), size)
+    
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+    
+    f = open(path, 'rb')
+    
+    if byte_range is None:
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        start, end = byte_range
+        f.seek(start)
+        response = StreamingHttpResponse(read_range(f, end - start + 1),
+                                         content_type=content_type, status=206)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    
+    response['Accept-Ranges'] = 'bytes'
+    if filename:
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    
+    return response
+
 class MimerDataException(Exception):
     """
     Raised if the content_type and data don't match
     """
     pass
 
+class BoundedStream(object):
+    """
+    File-like wrapper around a request body that raises
+    `RequestTooLarge` as soon as more than `limit` bytes
+    have been read. A `limit` of None means no limit.
+    """
+    def __init__(self, stream, limit=None):
+        self.stream = stream
+        self.limit = limit
+        self.bytes_read = 0
+        self.pushed = ''
+        
+    def count(self, data):
+        self.bytes_read += len(data)
+        if self.limit is not None and self.bytes_read > self.limit:
+            raise RequestTooLarge
+        return data
+        
+    def unread(self, data):
+        """
+        Puts `data` back, for the next read to return first. Loaders
+        use it to look at the start of a body before choosing how to
+        read it.
+        """
+        self.pushed = data + self.pushed
+        self.bytes_read -= len(data)
+        
+    def take(self, size=None):
+        if size is None:
+            size = len(self.pushed)
+        data, self.pushed = self.pushed[:size], self.pushed[size:]
+        return self.count(data)
+        
+    def read(self, size=None):
+        if self.pushed:
+            return self.take(size)
+        if size is None:
+            return self.count(self.stream.read())
+        return self.count(self.stream.read(size))
+        
+    def readline(self, size=None):
+        if self.pushed:
+            end = self.pushed.find('\n') + 1
+            if end:
+                return self.take(size is None and end or min(size, end))
+            if size is not None and size <= len(self.pushed):
+                return self.take(size)
+            # No newline put back: finish the line from the stream.
+            head = self.take()
+            return head + self.readline(size is not None and size - len(head) or None)
+        if size is None:
+            return self.count(self.stream.readline())
+        return self.count(self.stream.readline(size))
+        
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
 class Mimer(object):
     TYPES = dict()
+    STREAM_TYPES = dict()
+    
+    # Bare media type -> loader, precomputed from the above
+    # whenever a loader is registered or unregistered.
+    LOADERS = dict()
+    STREAM_LOADERS = dict()
     
     def __init__(self, request):
         self.request = request
@@ -168,11 +468,35 @@ class Mimer(object):
     def loader_for_type(self, ctype):
         """
         Gets a function ref to deserialize content
-        for a certain mimetype.
+        for a certain mimetype. Parameters such as
+        `charset` are ignored.
         """
-        for loadee, mimes in Mimer.TYPES.iteritems():
-            if ctype in mimes:
-                return loadee
+        return Mimer.LOADERS.get(media_type(ctype))
+
+    def stream_loader_for_type(self, ctype):
+        """
+        Gets a function ref that deserializes content of
+        a certain mimetype incrementally, or None.
+        """
+        return Mimer.STREAM_LOADERS.get(media_type(ctype))
+
+    def body(self):
+        """
+        Returns the request body as a `BoundedStream`, limited to
+        `FULCRUM_MAX_BODY_SIZE` bytes. A declared `Content-Length`
+        over the limit is refused before anything is read.
+        """
+        limit = getattr(settings, 'FULCRUM_MAX_BODY_SIZE', None)
+        
+        try:
+            length = int(self.request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        
+        if limit is not None and length > limit:
+            raise RequestTooLarge
+        
+        return BoundedStream(self.request, limit)
 
     def content_type(self):
         """
@@ -181,15 +505,15 @@ class Mimer(object):
         """
         type_formencoded = "application/x-www-form-urlencoded"
 
-        ctype = self.request.META.get('CONTENT_TYPE', type_formencoded)
+        ctype = self.request.META.get('CONTENT_TYPE') or type_formencoded
         
-        if ctype == type_formencoded:
+        if media_type(ctype) == type_formencoded:
             return None
         
         return ctype
         
 
-    def translate(self):
+    def translate(self, stream=False):
         """
         Will look at the `Content-type` sent by the client, and maybe
         deserialize the contents into the format they sent. This will
@@ -198,18 +522,45 @@ class Mimer(object):
         `request.data` instead, and the handler will have to read from
         there.
         
+        With `stream`, types that have a stream loader (JSON arrays and
+        NDJSON) aren't read here at all. `request.data_stream` is set to
+        an iterator over the records instead, which reads the body as
+        the handler consumes it. A stream loader returning None, like
+        `json_stream` for a lone object, leaves the body to the plain
+        loader.
+        
         It will also set `request.content_type` so the handler has an easy
         way to tell what's going on. `request.content_type` will always be
         None for form-encoded and/or multipart form data (what your browser sends.)
+        
+        Bodies over `FULCRUM_MAX_BODY_SIZE` raise `RequestTooLarge`.
+        A request that already has `request.data`, like a `batch`
+        sub-request, isn't read again.
         """    
         ctype = self.content_type()
         self.request.content_type = ctype
+        self.request.data_stream = None
+        
+        if getattr(self.request, 'data', None) is not None:
+            self.request.POST = self.request.PUT = dict()
+            return self.request
         
         if not self.is_multipart() and ctype:
+            body = self.body()
+            
+            streamer = stream and self.stream_loader_for_type(ctype)
+            records = None
+            if streamer:
+                records = streamer(body)
+            if records is not None:
+                self.request.data_stream = records
+                self.request.POST = self.request.PUT = dict()
+                return self.request
+            
             loadee = self.loader_for_type(ctype)
             
             try:
-                self.request.data = loadee(self.request.raw_post_data)
+                self.request.data = loadee(body.read())
                 
                 # Reset both POST and PUT from request, as its
                 # misleading having their presence around.
@@ -222,13 +573,30 @@ class Mimer(object):
     @classmethod
     def register(cls, loadee, types):
         cls.TYPES[loadee] = types
+        cls.LOADERS = cls.table(cls.TYPES)
         
     @classmethod
     def unregister(cls, loadee):
-        return cls.TYPES.pop(loadee)
+        types = cls.TYPES.pop(loadee)
+        cls.LOADERS = cls.table(cls.TYPES)
+        return types
+        
+    @classmethod
+    def register_stream(cls, loadee, types):
+        """
+        Registers a loader taking a file-like body and
+        yielding records, for `translate(stream=True)`.
+        """
+        cls.STREAM_TYPES[loadee] = types
+        cls.STREAM_LOADERS = cls.table(cls.STREAM_TYPES)
+        
+    @staticmethod
+    def table(types):
+        return dict([ (media_type(mime), loadee)
+                      for loadee, mimes in types.iteritems() for mime in mimes ])
 
-def translate_mime(request):
-    request = Mimer(request).translate()
+def translate_mime(request, stream=False):
+    request = Mimer(request).translate(stream)
     
 def require_mime(*mimes):
     """
@@ -249,7 +617,7 @@ def require_mime(*mimes):
         for idx, mime in enumerate(mimes):
             realmimes.add(rewrite.get(mime, mime))
 
-        if not m.content_type() in realmimes:
+        if not media_type(m.content_type() or '') in realmimes:
             return rc.BAD_REQUEST
 
         return f(self, request, *args, **kwargs)
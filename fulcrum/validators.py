@@ -0,0 +1,107 @@
+"""
+Request payload validation, compiled once per model.
+
+A `PayloadValidator` is built from the same field metadata
+`schemas.JSONSchema` publishes, so what the schema documents is what
+a create accepts. It type-checks and coerces a payload in one pass
+and never touches the database: related objects are resolved, and
+uniqueness is enforced, by the handler and the database.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db.models import ForeignKey, ManyToManyField
+
+from fulcrum import schemas
+
+# Compiled validators, keyed on model. Models only change
+# on deploy, so these live for the process.
+_validators = {}
+
+SCALAR_TYPES = ('integer', 'number', 'boolean', 'string')
+
+class PayloadValidator(object):
+    """
+    Validates payloads for `model`.
+    
+    Every local field and ManyToMany field is compiled up front into
+    a `(name, required, clean)` rule, where `clean` coerces one
+    submitted value. Related fields come out as the key of the
+    related object (its `to_field`, or primary key); `related` lists
+    those fields.
+    """
+    def __init__(self, model):
+        self.model = model
+        opts = model._meta
+        self.rules = [ self.compile(f) for f in opts.local_fields + opts.many_to_many ]
+        self.names = frozenset([ rule[0] for rule in self.rules ])
+        self.related = [ f for f in opts.local_fields + opts.many_to_many 
+                         if isinstance(f, (ForeignKey, ManyToManyField)) ]
+    
+    def compile(self, field):
+        type, format = schemas.field_type(field)
+        
+        if isinstance(field, ManyToManyField):
+            to_python = field.rel.get_related_field().to_python
+            def clean(value):
+                if value is None:
+                    return []
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                return [ to_python(v) for v in value ]
+        elif isinstance(field, ForeignKey):
+            to_python = field.rel.get_related_field().to_python
+            def clean(value):
+                if isinstance(value, (dict, list, tuple)):
+                    raise ValidationError('Expected a primary key.')
+                if value is None:
+                    if not field.null:
+                        raise ValidationError('This field cannot be null.')
+                    return None
+                return to_python(value)
+        else:
+            def clean(value):
+                if type in SCALAR_TYPES and isinstance(value, (dict, list, tuple)):
+                    raise ValidationError('Expected a single %s value.' % type)
+                # Field.clean runs to_python, choices, null/blank and the
+                # field validators, none of which need an instance.
+                return field.clean(value, None)
+        
+        return (field.name, field.blank == False, clean)
+    
+    def validate(self, attrs):
+        """
+        Checks `attrs` against the model. Returns a `(cleaned, errors)`
+        pair: the coerced values by field name, and a list of error
+        messages, empty if the payload is valid. Fields that can't be
+        blank are required.
+        """
+        cleaned = {}
+        errors = []
+        
+        unknown = set(attrs.keys()) - self.names
+        if unknown:
+            errors.append('Unknown fields: %s.' % ', '.join(sorted(unknown)))
+        
+        for name, required, clean in self.rules:
+            if name not in attrs:
+                if required:
+                    errors.append('Required field %s not found.' % name)
+                continue
+            
+            try:
+                cleaned[name] = clean(attrs[name])
+            except ValidationError, e:
+                errors.append('%s: %s' % (name, '; '.join(e.messages)))
+        
+        return cleaned, errors
+
+
+def get_validator(model):
+    """
+    Returns the compiled `PayloadValidator` for `model`.
+    """
+    try:
+        return _validators[model]
+    except KeyError:
+        validator = _validators[model] = PayloadValidator(model)
+        return validator